@@ -1,5 +1,9 @@
 import os
+import asyncio
 from crawlers import *
+from storage import ShardWriter, list_shards, read_dataset
+from export import export_wines, export_reviews, read_parquet, is_export_current
+from idset import dedup_in_place, iter_unique
 import pandas as pd
 import argparse
 from typing import List, Dict, Union
@@ -27,32 +31,31 @@ def parse_years(years_string: str):
 
 def remove_wine_duplicates(json_data: List[Dict]) -> List[Dict]:
     """
-    Function that eliminates duplicates from the list of wines
+    Function that eliminates duplicates from the list of wines in place, keeping the first entry of every vintage
     :param json_data: list of dictionaries containing wine data with duplicates
-    :return: list of dictionaries containing wine data without duplicates
+    :return: the same list, containing wine data without duplicates
     """
-    distinct_dict = {entry['vintage']['id']: entry for entry in json_data}
-    data_distinct = distinct_dict.values()
-    return list(data_distinct)
+    return dedup_in_place(json_data, lambda entry: entry['vintage']['id'])
 
 
 def remove_review_duplicates(json_data: List[Dict]) -> List[Dict]:
     """
-    Function that eliminates duplicates from the list of reviews
+    Function that eliminates duplicates from the list of reviews in place, keeping the first entry of every review
     :param json_data: list of dictionaries containing review data with duplicates
-    :return: list of dictionaries containing review data without duplicates
+    :return: the same list, containing review data without duplicates
     """
-    distinct_dict = {entry['id']: entry for entry in json_data}
-    data_distinct = distinct_dict.values()
-    return list(data_distinct)
+    return dedup_in_place(json_data, lambda entry: entry['id'])
 
 
 def wines_as_df(wine_list: List[Dict]) -> pd.DataFrame:
     """
     Function that removes duplicates and selects specific columns needed for further filtering.
-    :param wine_list: list of dictionaries containing wine data with duplicates
+    :param wine_list: list of dictionaries (or compact records, see records.py) containing wine data with duplicates;
+    it is left unchanged
     :return: Pandas DataFrame with wine data
     """
+    # a copy of the list, which is deduplicated in place; compact records are turned back to dictionaries for Pandas
+    wine_list = [entry.to_dict() if hasattr(entry, 'to_dict') else entry for entry in wine_list]
     full_df = pd.DataFrame(remove_wine_duplicates(wine_list))
     full_df = pd.json_normalize(full_df['vintage'])
     selected_columns = full_df[full_df['has_valid_ratings'] == True][['id', 'year', 'statistics.ratings_count',
@@ -61,15 +64,33 @@ def wines_as_df(wine_list: List[Dict]) -> pd.DataFrame:
     return selected_columns
 
 
-def read_wines_to_df(path: str) -> pd.DataFrame:
+def read_wines_to_df(backup_dir: str, dataset='full_match_list') -> pd.DataFrame:
     """
-    Function that reads pickle file and returns a DataFrame with selected columns on wine data
-    :param path: path to pickle file storing data
+    Function that reads shards of wine data and returns a DataFrame with selected columns on wine data
+    :param backup_dir: directory storing the shards
+    :param dataset: name of the dataset with wine data
     :return: Pandas DataFrame with wine data
     """
-    with open(path, 'rb') as f:
-        recovered_data = pickle.load(f)
-    return wines_as_df(recovered_data)
+    return wines_as_df(list(iter_unique(read_dataset(backup_dir, dataset), lambda entry: entry['vintage']['id'])))
+
+
+def read_wines_parquet_to_df(parquet_dir: str, countries: List[str] = None, years: List[Vintage] = None) \
+        -> pd.DataFrame:
+    """
+    Function that reads wine data exported to Parquet, loading only the columns and country/year partitions needed,
+    and returns a DataFrame with the same columns as wines_as_df
+    :param parquet_dir: root directory of the Parquet dataset with wines
+    :param countries: country names to read; all countries if None
+    :param years: years to read; all years if None
+    :return: Pandas DataFrame with wine data
+    """
+    full_df = read_parquet(parquet_dir, ['vintage.id', 'year', 'vintage.statistics.ratings_count', 'vintage.wine.id',
+                                         'country', 'vintage.has_valid_ratings'], countries, years)
+    selected_columns = full_df[full_df['vintage.has_valid_ratings'] == True].drop(columns='vintage.has_valid_ratings')
+    selected_columns.columns = ['id', 'year', 'rating_count', 'wine_id', 'country']
+    # partition values are strings, while vintage years are compared as integers
+    selected_columns['year'] = selected_columns['year'].map(lambda y: int(y) if y.isdigit() else y)
+    return selected_columns
 
 
 def filter_wines(df: pd.DataFrame, country: str, year: Vintage) -> pd.DataFrame:
@@ -84,6 +105,17 @@ def filter_wines(df: pd.DataFrame, country: str, year: Vintage) -> pd.DataFrame:
     return data
 
 
+def index_wines(df: pd.DataFrame) -> Dict[tuple, pd.DataFrame]:
+    """
+    Function that sorts wine data by rating count once and splits it by country and year, so that wines of any
+    country and year can be taken from the index without scanning the whole DataFrame again
+    :param df: Pandas DataFrame with wine data
+    :return: dictionary mapping (country, year) to Pandas DataFrame sorted by rating count, as returned by filter_wines
+    """
+    sorted_df = df.sort_values('rating_count', ascending=False, kind='stable')
+    return {key: group for key, group in sorted_df.groupby(['country', 'year'], sort=False)}
+
+
 def deduplicate_and_filter_reviews(review_list: List[Dict], year: Vintage) -> pd.DataFrame:
     """
     Function tht checks that DataFrame contains only specific values for year, and deletes records otherwise
@@ -97,22 +129,92 @@ def deduplicate_and_filter_reviews(review_list: List[Dict], year: Vintage) -> pd
     return selected_columns
 
 
-def save_reviews(review_list: List[Dict], backup_dir: str, country: str, year: Vintage) -> None:
+def read_known_reviews(backup_dir: str, country: str, year: Vintage) -> Dict[int, str]:
+    """
+    Function that finds the newest review already stored in the shards for every wine of a given country and year
+    :param backup_dir: name of directory that contains review data
+    :param country: Country name for the batch of reviews
+    :param year: Year for the batch of reviews
+    :return: dictionary mapping wine ids to the creation time of their newest stored review
     """
-    Function that dumps reviews as JSON object to a pickle file in the desired directory with a name specifying country and year
+    known = {}
+    for review in read_dataset(backup_dir, f"{country}_{year}"):
+        wine_id = review['vintage']['wine']['id']
+        created_at = review.get('created_at')
+        if created_at is not None and (wine_id not in known or created_at > known[wine_id]):
+            known[wine_id] = created_at
+    return known
+
+
+def read_known_reviews_from_sql(conn, year: Vintage) -> Dict[int, str]:
+    """
+    Function that finds the newest review already loaded to the database for every wine of a given year
+    :param conn: active connection to the database with the tables review, vintage_review and vintage
+    :param year: Year for the batch of reviews
+    :return: dictionary mapping wine ids to the creation time of their newest loaded review
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT v.wine_id, MAX(r.created_at) FROM review r "
+                "JOIN vintage_review vr ON vr.review_id = r.id JOIN vintage v ON v.id = vr.vintage_id "
+                "WHERE v.year = ? GROUP BY v.wine_id",
+                (0 if year == 'N.V.' else int(year),))  # non-vintage years are stored as zeroes
+    return {int(wine_id): created_at for wine_id, created_at in cur.fetchall() if created_at is not None}
+
+
+def save_reviews(review_list: List[Dict], backup_dir: str, country: str, year: Vintage, overwrite=True) -> None:
+    """
+    Function that writes reviews as compressed shards to the desired directory, in a dataset named after country and year
     :param review_list: list of dictionaries containing review data
     :param backup_dir: name of directory that should contain review data
     :param country: Country name for the batch of reviews
     :param year: Year for the batch of reviews
+    :param overwrite: whether to replace the reviews stored before, or add to them (after an incremental crawl)
     :return: None
     """
-    with open(f"{backup_dir}{country}_{year}", 'wb') as f:
-        pickle.dump(review_list, f)
+    with ShardWriter(backup_dir, f"{country}_{year}", overwrite=overwrite) as writer:
+        writer.write(review_list)
+
+
+def stream_reviews(crawler: Crawler, wines: pd.DataFrame, backup_dir: str, country: str, year: Vintage,
+                   concurrency=1, known: Dict[int, str] = None) -> int:
+    """
+    Function that downloads reviews page by page and appends them to compressed shards in a dataset named after
+    country and year, so that the whole batch is never held in memory
+    :param crawler: Crawler instance used to download reviews
+    :param wines: Pandas DataFrame with wines to download reviews for
+    :param backup_dir: name of directory that should contain review data
+    :param country: Country name for the batch of reviews
+    :param year: Year for the batch of reviews
+    :param concurrency: number of wines downloaded concurrently
+    :param known: creation time of the newest stored review of each wine; if given, only newer reviews are
+    downloaded and added to the stored ones
+    :return: number of reviews written
+    """
+    with ShardWriter(backup_dir, f"{country}_{year}", overwrite=known is None) as sink:
+        if concurrency > 1:
+            async def write_pages():
+                async for reviews_batch in crawler.iter_review_pages_async(wines, year, concurrency, known):
+                    sink.write(reviews_batch)
+            asyncio.run(write_pages())
+        else:
+            for reviews_batch in crawler.iter_review_pages(wines, year, known):
+                sink.write(reviews_batch)
+    return sink.records_written
+
+
+def finish_year(journal: CrawlJournal, year: Vintage) -> None:
+    """
+    Function that marks a year as stored in the journal of the run, and drops the pages of reviews of that year from
+    the journal, as the shards hold them now
+    """
+    journal.record(CrawlJournal.key('done', year), True)
+    journal.prune(lambda parts: (parts[0] in ('reviews', 'skipped') and parts[2] == year)
+                  or (parts[0] == 'known' and parts[1] == year))
 
 
 if __name__ == "__main__":
     """
-    Usage: python crawl.py [-h] [-v] [-p PATH] country years
+    Usage: python crawl.py [-h] [-v] [-p PATH] [-c CONCURRENCY] [-s] [-q PARQUET] [-f] [-i {shards,sql}] country years
     """
 
     parser = argparse.ArgumentParser(description='Load some wine reviews')
@@ -120,12 +222,27 @@ if __name__ == "__main__":
     parser.add_argument("years", type=str, help="Input the year or year range, eg. 2005:2010")
     parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
     parser.add_argument("-p", "--path", help="path to save the backup output", default="backup_data/")
+    parser.add_argument("-c", "--concurrency", type=int, default=1,
+                        help="number of wines whose reviews are downloaded concurrently")
+    parser.add_argument("-s", "--stream", action="store_true",
+                        help="write reviews to disk page by page instead of keeping them in memory")
+    parser.add_argument("-q", "--parquet", default=None,
+                        help="path to Parquet datasets to read wines from and export reviews to")
+    parser.add_argument("-f", "--fresh", action="store_true",
+                        help="discard the crawl journal and request everything again instead of resuming")
+    parser.add_argument("-i", "--incremental", choices=['shards', 'sql'], default=None,
+                        help="only download reviews newer than those already stored in the shards or in the database")
     args = parser.parse_args()
 
     country = args.country
     years_string = args.years
     verbose = args.verbose
     backup_dir = args.path
+    concurrency = args.concurrency
+    fresh = args.fresh
+    stream = args.stream
+    parquet_dir = args.parquet
+    incremental = args.incremental
 
     # country = 'France'
     # years_string = '1937'
@@ -134,25 +251,87 @@ if __name__ == "__main__":
 
     years = parse_years(years_string)
 
-    crawler = Crawler(backup_dir=backup_dir, verbose=verbose)
+    # the journal only serves a run interrupted with the same arguments, and is removed once the run completes
+    journal_path = CrawlJournal.run_path(backup_dir, country, years_string, incremental or 'full')
+    if fresh and os.path.isfile(journal_path):
+        os.remove(journal_path)
+    journal = CrawlJournal(journal_path)
+    if verbose and len(journal.offsets) > 0:
+        print(f"Resuming from the crawl journal with {len(journal.offsets)} completed requests")
+
+    crawler = Crawler(backup_dir=backup_dir, verbose=verbose, journal=journal)
 
-    if os.path.isfile(backup_dir + "full_match_list"):
-        wines_df = read_wines_to_df(backup_dir + "full_match_list")
+    if parquet_dir is not None and len(list_shards(backup_dir, 'full_match_list')) > 0:
+        if not is_export_current(backup_dir, parquet_dir + 'wines/'):  # never exported, or crawled again since
+            export_wines(backup_dir, parquet_dir + 'wines/')
+        wines_df = read_wines_parquet_to_df(parquet_dir + 'wines/', [country], years)
+    elif len(list_shards(backup_dir, 'full_match_list')) > 0:
+        wines_df = read_wines_to_df(backup_dir)
     else:
         wines = crawler.download_all_wines(105, 107, with_prices=True, inter_backup=False, final_backup=False)
         wines_df = wines_as_df(wines)
 
+    catalogue = index_wines(wines_df)
+    no_wines = wines_df.iloc[0:0]
+
     for year in years:
-        wines = filter_wines(wines_df, country, year)
+        wines = catalogue.get((country, year), no_wines)
+
+        if CrawlJournal.key('done', year) in journal:
+            if verbose:
+                print(f"Year {year} was stored before the run was interrupted")
+            continue
 
         if len(wines) > 0:
             if verbose:
                 print(f"Loading year {year}, with {len(wines)} wines")
 
-            reviews = crawler.download_reviews(wines, country, year)
-            save_reviews(reviews, backup_dir + 'reviews/', country, year)
+            known = None
+            # read once per run: pages streamed before an interruption would otherwise move the newest stored review
+            # of their wine past the older new reviews not downloaded yet
+            known_key = CrawlJournal.key('known', year)
+            if incremental is not None and known_key in journal:
+                known = {int(wine_id): created_at for wine_id, created_at in journal.get(known_key).items()}
+            elif incremental == 'shards':
+                known = read_known_reviews(backup_dir + 'reviews/', country, year)
+            elif incremental == 'sql':
+                from insert import connect_to_vivino_db  # needs mariadb, which crawling does not need otherwise
+                conn = connect_to_vivino_db()
+                try:
+                    known = read_known_reviews_from_sql(conn, year)
+                finally:
+                    conn.close()
+            if known is not None and known_key not in journal:
+                journal.record(known_key, known)
+            if verbose and known is not None:
+                print(f"{len(known)} wines already have reviews stored, only newer reviews will be downloaded")
 
-            if verbose:
-                reviews_df = deduplicate_and_filter_reviews(reviews, year)
-                print(f"After processing, the data on {country} in {year} includes {reviews_df['id'].nunique()} "
-                      f"unique reviews on {reviews_df['vintage.wine.id'].nunique()} wines")
+            if stream:
+                reviews_num = stream_reviews(crawler, wines, backup_dir + 'reviews/', country, year, concurrency,
+                                             known)
+                if verbose:
+                    print(f"Program wrote {reviews_num} reviews (before deduplication) on {country} in {year}")
+                    print(f"In total: {crawler.stats.summary(year)}")
+                if parquet_dir is not None:
+                    export_reviews(backup_dir + 'reviews/', parquet_dir + 'reviews/', country, year)
+                finish_year(journal, year)
+                continue
+
+            if concurrency > 1:
+                reviews = asyncio.run(crawler.download_reviews_async(wines, country, year, concurrency, known))
+            else:
+                reviews = crawler.download_reviews(wines, country, year, known)
+            save_reviews(reviews, backup_dir + 'reviews/', country, year, overwrite=known is None)
+            if parquet_dir is not None:
+                export_reviews(backup_dir + 'reviews/', parquet_dir + 'reviews/', country, year)
+
+            if verbose and len(reviews) > 0:
+                year_stats = crawler.stats.years[year]
+                print(f"After processing, the data on {country} in {year} includes {year_stats['matching']} "
+                      f"unique reviews on {len(year_stats['wines'])} wines")
+            finish_year(journal, year)
+
+    if len(crawler.skipped_wines) > 0:
+        print(f"Reviews of {len(crawler.skipped_wines)} wines could not be downloaded and were skipped")
+
+    journal.remove()
@@ -1,11 +1,305 @@
-from typing import List, Dict
+from typing import List, Dict, Iterator, AsyncIterator, Callable
+import os
 import requests
-from ratelimiter import RateLimiter
+import aiohttp
+import asyncio
+import threading
 import json
 import time
 import math
-import pickle
+import random
+import re
+from email.utils import parsedate_to_datetime
 import pandas as pd
+from storage import ShardWriter
+from idset import IdSet
+
+
+class TokenBucket:
+    """
+    Thread-safe and asyncio-safe token bucket allowing `rate` calls per second on average, with bursts of up to
+    `burst` calls. Tokens are reserved under a lock and the caller then waits outside of it, so neither threads
+    nor coroutines hold the bucket while sleeping.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.total_wait = 0.0  # overall time callers were asked to wait for a token, in seconds
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _reserve(self) -> float:
+        """
+        Function that takes one token (borrowing it in advance if the bucket is empty) and returns the time to wait
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            wait = max(0.0, -self.tokens / self.rate)
+            self.total_wait += wait
+            return wait
+
+    def acquire(self) -> None:
+        """
+        Function that blocks the calling thread until a token is available
+        """
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """
+        Coroutine that suspends until a token is available, without blocking the event loop
+        """
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def current_wait(self) -> float:
+        """
+        Function that returns how long a new call would have to wait right now, in seconds
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def set_rate(self, rate: float) -> None:
+        """
+        Function that changes the refill rate, keeping the tokens accumulated so far
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+
+class CircuitBreaker:
+    """
+    Watches responses of one endpoint family: when `threshold` responses with status 429 arrive within `window`
+    seconds, the rate of the token bucket is multiplied by `slowdown`, but never below `min_factor` of the original
+    rate. After `recovery_calls` successful calls in a row, or `recovery_time` seconds of successful calls without a
+    429 (whichever comes first, so that a very low rate recovers too), the rate is raised back step by step, up to the
+    original one.
+    """
+
+    def __init__(self, bucket: TokenBucket, threshold=3, window=60, slowdown=0.5, recovery_calls=100,
+                 min_factor=1 / 16, recovery_time=120):
+        self.bucket = bucket
+        self.base_rate = bucket.rate
+        self.threshold = threshold
+        self.window = window
+        self.slowdown = slowdown
+        self.recovery_calls = recovery_calls
+        self.min_rate = bucket.rate * min_factor
+        self.recovery_time = recovery_time
+        self.throttled = []
+        self.successes = 0
+        self.calm_since = time.monotonic()  # last 429 or change of rate
+        self._lock = threading.Lock()
+
+    def record_throttled(self) -> None:
+        """
+        Function that registers a response with status 429 and slows the bucket down if such responses cluster
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.throttled = [t for t in self.throttled if t > now - self.window] + [now]
+            self.successes = 0
+            self.calm_since = now
+            if len(self.throttled) >= self.threshold:
+                self.bucket.set_rate(max(self.min_rate, self.bucket.rate * self.slowdown))
+                self.throttled = []
+
+    def record_success(self) -> None:
+        """
+        Function that registers a successful response and restores the bucket's rate after enough of them, or after
+        long enough without a 429
+        """
+        with self._lock:
+            self.successes += 1
+            now = time.monotonic()
+            if self.bucket.rate < self.base_rate and (self.successes >= self.recovery_calls
+                                                      or now - self.calm_since >= self.recovery_time):
+                self.bucket.set_rate(min(self.base_rate, self.bucket.rate / self.slowdown))
+                self.successes = 0
+                self.calm_since = now
+
+
+class ApiError(Exception):
+    """
+    Raised when a request to vivino API keeps failing after all retries, or fails in a way retrying cannot fix
+    (permanent, eg. a client error)
+    """
+
+    def __init__(self, message: str, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class CrawlJournal:
+    """
+    Append-only journal of completed crawl units, stored as JSON lines. Each line holds the key of a unit, eg.
+    ["vintages", price_min, price_max, page] or ["reviews", wine_id, year, page], together with its result, so that a
+    restarted crawl can reuse finished units instead of requesting them again. Only file offsets are kept in memory.
+    A journal belongs to a single run (see run_path) and is removed once the run completes, so that it never serves
+    old pages to a later crawl.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            self._load_offsets()
+        self._writer = open(path, 'ab')
+        self._reader = open(path, 'rb')
+
+    def _load_offsets(self) -> None:
+        """
+        Function that indexes the journal on disk, dropping a partially written last line left by a crash
+        """
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                self.offsets[entry['key']] = offset
+                offset += len(line)
+        os.truncate(self.path, offset)
+
+    @staticmethod
+    def run_path(directory: str, *run_args) -> str:
+        """
+        Function that returns the path of the journal of a run, named after the arguments identifying the run, eg.
+        crawl_journal_France_2005-2010_full for a full crawl of French wines from 2005 to 2010
+        """
+        name = re.sub(r'[^\w.-]+', '-', '_'.join(str(arg) for arg in run_args))
+        return os.path.join(directory, f"crawl_journal_{name}")
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Function that builds a journal key from the parts identifying a unit of work
+        """
+        return json.dumps([part if isinstance(part, (str, float)) else int(part) for part in parts])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.offsets
+
+    def get(self, key: str) -> any:
+        """
+        Function that returns the stored result of a completed unit
+        """
+        with self._lock:
+            self._reader.seek(self.offsets[key])
+            return json.loads(self._reader.readline())['result']
+
+    def record(self, key: str, result: any) -> None:
+        """
+        Function that durably appends a completed unit with its result to the journal
+        """
+        line = (json.dumps({'key': key, 'result': result}) + '\n').encode()
+        with self._lock:
+            offset = self._writer.tell()
+            self._writer.write(line)
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self.offsets[key] = offset
+
+    def close(self) -> None:
+        self._writer.close()
+        self._reader.close()
+
+    def prune(self, drop: Callable[[list], bool]) -> None:
+        """
+        Function that rewrites the journal without the units whose key parts match drop, eg. once their results are
+        stored in shards, so that the journal does not keep a second copy of them until the end of the run
+        """
+        with self._lock:
+            self._writer.close()
+            kept = {}
+            with open(self.path + '.tmp', 'wb') as f:
+                for key, offset in sorted(self.offsets.items(), key=lambda item: item[1]):
+                    if drop(json.loads(key)):
+                        continue
+                    self._reader.seek(offset)
+                    kept[key] = f.tell()
+                    f.write(self._reader.readline())
+                f.flush()
+                os.fsync(f.fileno())
+            self._reader.close()
+            os.replace(self.path + '.tmp', self.path)
+            self.offsets = kept
+            self._writer = open(self.path, 'ab')
+            self._reader = open(self.path, 'rb')
+
+    def remove(self) -> None:
+        """
+        Function that closes the journal and deletes it, once the run it belongs to has completed
+        """
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class CrawlStats:
+    """
+    Statistics of a crawl accumulated while pages arrive (only in verbose mode), so that they are reported without a
+    second pass over the reviews: requests and bytes received per endpoint family, pages of reviews, and for every
+    crawled year the unique reviews downloaded, the unique reviews of vintages of that year and the wines they belong to
+    """
+    REPORT_EVERY = 500  # pages of reviews between two progress reports in verbose mode
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.requests = {}
+        self.bytes_received = {}
+        self.pages = 0
+        self.years = {}  # year -> {'reviews': int, 'matching': int, 'wines': IdSet}
+        self._review_ids = IdSet()
+        self._lock = threading.Lock()
+
+    def record_response(self, endpoint: str, content: bytes) -> None:
+        """
+        Function that counts a response received from the API, successful or not
+        """
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_received[endpoint] = self.bytes_received.get(endpoint, 0) + len(content)
+
+    def record_reviews(self, reviews_batch: List[Dict], year) -> None:
+        """
+        Function that counts a page of reviews downloaded for a given year; reviews seen before are only counted once
+        """
+        with self._lock:
+            self.pages += 1
+            year_stats = self.years.setdefault(year, {'reviews': 0, 'matching': 0, 'wines': IdSet()})
+            for review in reviews_batch:
+                if self._review_ids.add(review['id']):
+                    year_stats['reviews'] += 1
+                    if review['vintage']['year'] == year:
+                        year_stats['matching'] += 1
+                        year_stats['wines'].add(review['vintage']['wine']['id'])
+
+    def requests_per_second(self) -> float:
+        return sum(self.requests.values()) / max(time.time() - self.started_at, 1e-9)
+
+    def summary(self, year) -> str:
+        """
+        Function that describes the reviews downloaded so far for a given year and the traffic of the whole crawl
+        """
+        year_stats = self.years.get(year, {'reviews': 0, 'matching': 0, 'wines': ()})
+        return f"{year_stats['reviews']} unique reviews for the year {year}, {year_stats['matching']} of them on " \
+               f"{len(year_stats['wines'])} wines of that year; {self.pages} pages and " \
+               f"{round(sum(self.bytes_received.values()) / 1024 ** 2, 1)} Mb in {sum(self.requests.values())} " \
+               f"requests ({round(self.requests_per_second(), 2)} requests/s)"
 
 
 class Crawler:
@@ -14,117 +308,503 @@ class Crawler:
         'Accept': 'application/json',
         'Content-Type': 'application/json',
     }
-
-    def __init__(self, backup_dir, verbose):
+    # templates are read from the instance, so they can be pointed elsewhere, eg. to misc/mock_vivino.py
+    EXPLORE_PAGE_TEMPLATE = 'https://www.vivino.com/api/explore/explore?country_code=GB&currency_code=GBP' \
+                            '&grape_filter=varietal&min_rating=1&order_by=ratings_average&order=desc&page={}' \
+                            '&per_page=100&price_range_min={}&price_range_max={}'
+    REVIEWS_PAGE_TEMPLATE = 'https://www.vivino.com/api/wines/{}/latest_reviews?year={}&per_page=50&page={}'
+    # requests per second and burst size for each endpoint family
+    RATE_LIMITS = {
+        'explore': (1, 1),
+        'reviews': (1, 1),
+    }
+    REQUEST_TIMEOUT = 60  # seconds
+    MAX_RETRIES = 6
+    BACKOFF_BASE = 2  # seconds, doubled on every retry
+    BACKOFF_MAX = 300  # seconds
+    EXPLORE_PER_PAGE = 100
+    EXPLORE_PAGE_CAP = 80  # explore endpoint does not return matches beyond this page
+    MIN_PRICE_STEP = 0.01  # narrowest price range the partitioning will split
+
+    def __init__(self, backup_dir, verbose, rate_limits=None, max_retries=MAX_RETRIES, journal: CrawlJournal = None):
         self.backup_dir = backup_dir
         self.verbose = verbose
+        self.max_retries = max_retries
+        self.journal = journal
+        limits = {**Crawler.RATE_LIMITS, **(rate_limits or {})}
+        self.rate_limiters = {endpoint: TokenBucket(rate, burst) for endpoint, (rate, burst) in limits.items()}
+        self.circuit_breakers = {endpoint: CircuitBreaker(bucket) for endpoint, bucket in self.rate_limiters.items()}
+        self.stats = CrawlStats() if verbose else None  # only kept for the reports of verbose mode
+        self.skipped_wines = []  # (wine id, year, reason) of wines whose reviews could not be downloaded
+
+    def rate_limit_wait(self) -> Dict[str, float]:
+        """
+        Function that returns the current wait time (in seconds) for a new request on each endpoint family
+        """
+        return {endpoint: bucket.current_wait() for endpoint, bucket in self.rate_limiters.items()}
 
-    @RateLimiter(max_calls=1, period=1)
-    def _call_to_api(self, s, page):
+    @staticmethod
+    def _backoff_delay(attempt: int, retry_after=None) -> float:
         """
-        Function extracting total number of records and JSON list from vivino API explore endpoint with rate limiting
+        Function that returns how long to wait before the next attempt: the server's Retry-After value if it sent one,
+        otherwise an exponential backoff with full jitter
         """
-        response = s.get(page)
-        json_str = response.content
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(Crawler.BACKOFF_MAX, Crawler.BACKOFF_BASE * 2 ** attempt))
+
+    def _check_response(self, page, endpoint, status: int, content: bytes):
+        """
+        Function that returns the decoded JSON of a successful response, or None if the request should be retried.
+        Raises ApiError for client errors that retrying cannot fix.
+        """
+        if status == 429:
+            self.circuit_breakers[endpoint].record_throttled()
+            return None
+        if status >= 500:
+            return None
+        if status >= 400:
+            raise ApiError(f"Request to {page} failed with status {status}: {content[:200]}", permanent=True)
         try:
-            json_obj = json.loads(json_str)
-            return json_obj
-        except:
-            print(response.content)
+            json_obj = json.loads(content)
+        except ValueError:
+            return None
+        self.circuit_breakers[endpoint].record_success()
+        return json_obj
+
+    def _retry_message(self, page, attempt, problem, delay) -> None:
+        """
+        Function that reports a failed attempt when running in verbose mode
+        """
+        if self.verbose:
+            print(f"Request to {page} failed ({problem}), attempt {attempt + 1} of {self.max_retries + 1}. "
+                  f"Retrying in {round(delay, 1)} s.")
+
+    def _call_to_api(self, s, page, endpoint='explore'):
+        """
+        Function extracting total number of records and JSON list from vivino API with rate limiting per endpoint family,
+        retrying failed requests with exponential backoff
+        """
+        problem = None
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiters[endpoint].acquire()
+            retry_after = None
+            try:
+                response = s.get(page, timeout=Crawler.REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                problem = repr(e)
+            else:
+                if self.stats is not None:
+                    self.stats.record_response(endpoint, response.content)
+                json_obj = self._check_response(page, endpoint, response.status_code, response.content)
+                if json_obj is not None:
+                    return json_obj
+                problem = f"status {response.status_code}"
+                retry_after = response.headers.get('Retry-After')
+            if attempt < self.max_retries:
+                delay = Crawler._backoff_delay(attempt, retry_after)
+                self._retry_message(page, attempt, problem, delay)
+                time.sleep(delay)
+        raise ApiError(f"Request to {page} failed after {self.max_retries + 1} attempts ({problem})")
 
     def _parse_vintages(self, s, page_num: int, price_min: int, price_max: int):
         """
         Function that extracts records from a single page
         """
-        page_template = 'https://www.vivino.com/api/explore/explore?country_code=GB&currency_code=GBP' \
-                        '&grape_filter=varietal&min_rating=1&order_by=ratings_average&order=desc&page={}' \
-                        '&per_page=100&price_range_min={}&price_range_max={}'
-        page = page_template.format(page_num, price_min, price_max)
+        key = CrawlJournal.key('vintages', price_min, price_max, page_num)
+        if self.journal is not None and key in self.journal:
+            return self.journal.get(key)
+        page = self.EXPLORE_PAGE_TEMPLATE.format(page_num, price_min, price_max)
         json_obj = self._call_to_api(s, page)
-        return json_obj['explore_vintage']['matches']
+        matches = json_obj['explore_vintage']['matches']
+        if self.journal is not None:
+            self.journal.record(key, matches)
+        return matches
 
     def _parse_vintage_num(self, s, page_num: int, price_min: int, price_max: int):
         """
         Function that extracts total number of matches
         """
-        page_template = 'https://www.vivino.com/api/explore/explore?country_code=GB&currency_code=GBP' \
-                        '&grape_filter=varietal&min_rating=1&order_by=ratings_average&order=desc&page={}' \
-                        '&per_page=100&price_range_min={}&price_range_max={}'
-        page = page_template.format(page_num, price_min, price_max)
+        key = CrawlJournal.key('count', price_min, price_max)
+        if self.journal is not None and key in self.journal:
+            return self.journal.get(key)
+        page = self.EXPLORE_PAGE_TEMPLATE.format(page_num, price_min, price_max)
         json_obj = self._call_to_api(s, page)
-        return json_obj['explore_vintage']['records_matched']
+        records_matched = json_obj['explore_vintage']['records_matched']
+        if self.journal is not None:
+            self.journal.record(key, records_matched)
+        return records_matched
 
-    def _parse_reviews(self, s, wine_id: int, year: str, page_num: int):
+    def _parse_reviews(self, s, wine_id: int, year: str, page_num: int, newest: str = None):
         """
         Function that returns reviews extracted for a particular wine ID and year, and a particular page
         """
-        page_template = 'https://www.vivino.com/api/wines/{}/latest_reviews?year={}&per_page=50&page={}'
-        page = page_template.format(wine_id, year, page_num)
-        json_obj = self._call_to_api(s, page)
+        # pages of an incremental crawl are journaled apart, as they are compared with a different newest review
+        key = CrawlJournal.key('reviews', wine_id, year, page_num, *([newest] if newest is not None else []))
+        if self.journal is not None and key in self.journal:
+            return self.journal.get(key)
+        page = self.REVIEWS_PAGE_TEMPLATE.format(wine_id, year, page_num)
+        json_obj = self._call_to_api(s, page, 'reviews')
+        if self.journal is not None:
+            self.journal.record(key, json_obj['reviews'])
         return json_obj['reviews']
 
-    def download_reviews(self, wines: pd.DataFrame, country, year) -> List[Dict]:
+    async def _call_to_api_async(self, session: aiohttp.ClientSession, page, endpoint='reviews'):
         """
-        Function that returns all reviews extracted for a particular wine ID and year, and appends them to a given list.
+        Coroutine extracting JSON object from vivino API with rate limiting, sharing a single connection pool and
+        retrying failed requests with exponential backoff
+        """
+        problem = None
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiters[endpoint].acquire_async()
+            retry_after = None
+            try:
+                async with session.get(page, timeout=aiohttp.ClientTimeout(total=Crawler.REQUEST_TIMEOUT)) as response:
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                problem = repr(e)
+            else:
+                if self.stats is not None:
+                    self.stats.record_response(endpoint, content)
+                json_obj = self._check_response(page, endpoint, status, content)
+                if json_obj is not None:
+                    return json_obj
+                problem = f"status {status}"
+            if attempt < self.max_retries:
+                delay = Crawler._backoff_delay(attempt, retry_after)
+                self._retry_message(page, attempt, problem, delay)
+                await asyncio.sleep(delay)
+        raise ApiError(f"Request to {page} failed after {self.max_retries + 1} attempts ({problem})")
+
+    async def _parse_reviews_async(self, session: aiohttp.ClientSession, wine_id: int, year: str, page_num: int,
+                                   newest: str = None):
+        """
+        Coroutine that returns reviews extracted for a particular wine ID and year, and a particular page
+        """
+        key = CrawlJournal.key('reviews', wine_id, year, page_num, *([newest] if newest is not None else []))
+        if self.journal is not None and key in self.journal:
+            return self.journal.get(key)
+        page = self.REVIEWS_PAGE_TEMPLATE.format(wine_id, year, page_num)
+        json_obj = await self._call_to_api_async(session, page, 'reviews')
+        if self.journal is not None:
+            self.journal.record(key, json_obj['reviews'])
+        return json_obj['reviews']
+
+    @staticmethod
+    def _new_reviews(reviews_batch: List[Dict], newest: str = None) -> tuple:
+        """
+        Function that keeps the reviews of a page created after the newest review already stored
+        :param reviews_batch: page of latest reviews, which come from the newest to the oldest
+        :param newest: creation time of the newest review already stored (ISO format, so that strings compare as
+        times); all reviews are new if None
+        :return: (new reviews, whether the page reached reviews already stored) tuple
+        """
+        if newest is None:
+            return reviews_batch, False
+        new_reviews = [review for review in reviews_batch
+                       if review.get('created_at') is None or review['created_at'] > newest]
+        return new_reviews, len(new_reviews) < len(reviews_batch)
+
+    @staticmethod
+    def _as_records(batch: List[Dict], record_type=None) -> List:
+        """
+        Function that turns a page of raw JSON into compact records of a given type (see records.py), if any
+        """
+        if record_type is None:
+            return batch
+        return [record_type.from_json(entry) for entry in batch]
+
+    def _record_reviews(self, reviews_batch: List[Dict], year) -> None:
+        """
+        Function that feeds a page of reviews to the crawl statistics, reporting them every few pages in verbose mode
+        """
+        if self.stats is None:
+            return
+        self.stats.record_reviews(reviews_batch, year)
+        if self.stats.pages % CrawlStats.REPORT_EVERY == 0:
+            print(f"So far: {self.stats.summary(year)}")
+
+    def _skip_key(self, wine_id: int, year, newest: str = None) -> str:
+        return CrawlJournal.key('skipped', wine_id, year, *([newest] if newest is not None else []))
+
+    def _is_skipped(self, wine_id: int, year, newest: str = None) -> bool:
+        """
+        Function that tells whether an earlier run of the crawl skipped a wine for good (see _skip_wine)
+        """
+        return self.journal is not None and self._skip_key(wine_id, year, newest) in self.journal
+
+    def _skip_wine(self, wine_id: int, year, newest: str, error: ApiError) -> None:
+        """
+        Function that gives up on the reviews of a single wine after a failed request, so that the crawl goes on with
+        the next wine. Permanent failures are journaled, so a resumed crawl does not request the wine again; wines
+        skipped after running out of retries are requested again.
+        """
+        self.skipped_wines.append((int(wine_id), year, str(error)))
+        print(f"Skipping reviews of wine {wine_id} for the year {year}: {error}")
+        if error.permanent and self.journal is not None:
+            self.journal.record(self._skip_key(wine_id, year, newest), str(error))
+
+    def _wine_review_pages(self, s, wine_id: int, num: int, year, newest: str = None) -> Iterator[List[Dict]]:
+        """
+        Generator that pages through all reviews of a single wine in order, stopping at the first empty page, or at
+        the first page reaching reviews created before the newest one already stored. A wine whose requests fail is
+        skipped (see _skip_wine).
+        """
+        if self._is_skipped(wine_id, year, newest):
+            return
+        max_pages = math.ceil(num / 50)
+        for it in range(1, max_pages + 1):
+            try:
+                reviews_batch = self._parse_reviews(s, wine_id, year, it, newest)
+            except ApiError as e:
+                self._skip_wine(wine_id, year, newest, e)
+                return
+            if len(reviews_batch) == 0:
+                break
+            reviews_batch, reached_stored = Crawler._new_reviews(reviews_batch, newest)
+            self._record_reviews(reviews_batch, year)
+            if len(reviews_batch) > 0:
+                yield reviews_batch
+            if reached_stored:
+                break
+
+    async def _wine_review_pages_async(self, session: aiohttp.ClientSession, wine_id: int, num: int, year,
+                                       newest: str = None) -> AsyncIterator[List[Dict]]:
+        """
+        Asynchronous generator that pages through all reviews of a single wine in order, stopping at the first empty page,
+        or at the first page reaching reviews created before the newest one already stored. A wine whose requests fail
+        is skipped (see _skip_wine).
         """
+        if self._is_skipped(wine_id, year, newest):
+            return
+        max_pages = math.ceil(num / 50)
+        for it in range(1, max_pages + 1):
+            try:
+                reviews_batch = await self._parse_reviews_async(session, wine_id, year, it, newest)
+            except ApiError as e:
+                self._skip_wine(wine_id, year, newest, e)
+                return
+            if len(reviews_batch) == 0:
+                break
+            reviews_batch, reached_stored = Crawler._new_reviews(reviews_batch, newest)
+            self._record_reviews(reviews_batch, year)
+            if len(reviews_batch) > 0:
+                yield reviews_batch
+            if reached_stored:
+                break
+
+    def iter_review_pages(self, wines: pd.DataFrame, year, known: Dict[int, str] = None, record_type=None) \
+            -> Iterator[List[Dict]]:
+        """
+        Generator that yields pages of reviews for the given wines and year as soon as they are downloaded.
+        Given the creation time of the newest review stored for each wine, only reviews created after it are downloaded.
+        Given a record type (eg. records.Review), reviews are yielded as compact records instead of raw JSON.
+        """
+        known = known or {}
         s = requests.Session()
         s.headers.update(Crawler.SESSION_HEADERS)
+        try:
+            for index, row in wines.iterrows():
+                for reviews_batch in self._wine_review_pages(s, row['wine_id'], row['rating_count'], year,
+                                                             known.get(int(row['wine_id']))):
+                    yield Crawler._as_records(reviews_batch, record_type)
+        finally:
+            s.close()
+
+    async def _iter_positioned_review_pages_async(self, wines: pd.DataFrame, year, concurrency,
+                                                  known: Dict[int, str] = None) -> AsyncIterator[tuple]:
+        """
+        Asynchronous generator that yields (position of the wine in the frame, page of reviews) tuples as they arrive,
+        keeping up to `concurrency` wines in flight over one shared connection pool
+        """
+        known = known or {}
+        todo = asyncio.Queue()
+        for position, (index, row) in enumerate(wines.iterrows()):
+            todo.put_nowait((position, row['wine_id'], row['rating_count'], known.get(int(row['wine_id']))))
+        # bounded, so that workers wait for the consumer instead of piling pages up in memory
+        pages = asyncio.Queue(maxsize=2 * concurrency)
+
+        async def worker(session):
+            try:
+                while not todo.empty():
+                    position, wine_id, num, newest = todo.get_nowait()
+                    async for reviews_batch in self._wine_review_pages_async(session, wine_id, num, year, newest):
+                        await pages.put((position, reviews_batch))
+            finally:
+                await pages.put(None)
+
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(headers=Crawler.SESSION_HEADERS, connector=connector) as session:
+            workers = [asyncio.ensure_future(worker(session)) for _ in range(concurrency)]
+            try:
+                finished = 0
+                while finished < len(workers):
+                    item = await pages.get()
+                    if item is None:
+                        finished += 1
+                        for task in workers:
+                            if task.done() and task.exception() is not None:
+                                raise task.exception()
+                    else:
+                        yield item
+            finally:
+                for task in workers:
+                    task.cancel()
+
+    async def iter_review_pages_async(self, wines: pd.DataFrame, year, concurrency=8, known: Dict[int, str] = None,
+                                      record_type=None) -> AsyncIterator[List[Dict]]:
+        """
+        Asynchronous generator that yields pages of reviews for the given wines and year as soon as they arrive.
+        Pages of a single wine come in order, but pages of different wines may interleave. See iter_review_pages
+        for known and record_type.
+        """
+        async for position, reviews_batch in self._iter_positioned_review_pages_async(wines, year, concurrency,
+                                                                                      known):
+            yield Crawler._as_records(reviews_batch, record_type)
 
+    def download_reviews(self, wines: pd.DataFrame, country, year, known: Dict[int, str] = None) -> List[Dict]:
+        """
+        Function that returns all reviews extracted for a particular wine ID and year, and appends them to a given list.
+        Given the creation time of the newest review stored for each wine, only reviews created after it are returned.
+        """
         reviews = []
         timepoint_0 = time.time()
 
-        for index, row in wines.iterrows():
-            wine_id = row['wine_id']
-            num = row['rating_count']
+        for reviews_batch in self.iter_review_pages(wines, year, known):
+            reviews += reviews_batch
+
+        if self.verbose:
+            print(f"Program uploaded {len(reviews)} reviews for {country} for the year {year}. "
+                  f"It took app. {round((time.time() - timepoint_0) / 60, 2)} minutes to run")
+            if self.stats is not None:
+                print(f"In total: {self.stats.summary(year)}")
+            print(f"Requests to reviews API spent app. {round(self.rate_limiters['reviews'].total_wait / 60, 2)} "
+                  f"minutes in total waiting for the rate limiter")
 
-            max_pages = math.ceil(num / 50)
+        return reviews
 
-            # if self.verbose:
-            #     print(
-            #         f"The program will send up to {max_pages} requests to reviews API to extract up to {num} reviews for wine {wine_id}")
+    async def download_reviews_async(self, wines: pd.DataFrame, country, year, concurrency=8,
+                                     known: Dict[int, str] = None) -> List[Dict]:
+        """
+        Coroutine that returns all reviews extracted for a particular wine ID and year, keeping up to `concurrency`
+        wines in flight at the same time over one shared connection pool. Pages of a single wine are requested
+        one after another, and the result is ordered exactly as in download_reviews.
+        """
+        timepoint_0 = time.time()
 
-            for it in range(1, max_pages + 1):
-                reviews_batch = self._parse_reviews(s, wine_id, year, it)
-                if len(reviews_batch) == 0:
-                    break
-                else:
-                    reviews += reviews_batch
+        results = [[] for _ in range(len(wines))]
+        async for position, reviews_batch in self._iter_positioned_review_pages_async(wines, year, concurrency,
+                                                                                      known):
+            results[position] += reviews_batch
 
-            # if self.verbose and index % 100 == 0:
-            #     print(
-            #         f"Record no. {index} with id {wine_id} finished. Currently stores {len(set([review['id'] for review in reviews]))} records")
+        reviews = [review for wine_reviews in results for review in wine_reviews]
 
         if self.verbose:
-            print(f"Program uploaded {len(set([review['id'] for review in reviews]))} reviews for {country} "
-                  f"for the year {year}. It took app. {round((time.time() - timepoint_0) / 60, 2)} minutes to run")
-
-        s.close()
+            print(f"Program uploaded {len(reviews)} reviews for {country} for the year {year}. "
+                  f"It took app. {round((time.time() - timepoint_0) / 60, 2)} minutes to run")
+            if self.stats is not None:
+                print(f"In total: {self.stats.summary(year)}")
+            print(f"Requests to reviews API spent app. {round(self.rate_limiters['reviews'].total_wait / 60, 2)} "
+                  f"minutes in total waiting for the rate limiter")
 
         return reviews
 
-    def download_all_wines(self, price_min=0, price_max=400, with_prices=True, inter_backup=True, final_backup=True):
+    def _partition_prices(self, s, price_min, price_max) -> List[tuple]:
         """
-        Function that iterates over small price ranges to extract all the data within a given range between min price and max price.
-        If necessary, the function may store intermediate backups and/or a final backup inside pickle files.
+        Function that bisects the price range until every partition fits within the page cap of the explore endpoint,
+        then merges neighbouring partitions as long as their records still fit within it.
+        Returns a sorted list of (price_min, price_max, records_num) tuples covering the whole range.
         """
-        s = requests.Session()
-        s.headers.update(Crawler.SESSION_HEADERS)
+        capacity = Crawler.EXPLORE_PAGE_CAP * Crawler.EXPLORE_PER_PAGE
+        partitions = []
+        ranges_to_check = [(price_min, price_max)]
+        while ranges_to_check:
+            low, high = ranges_to_check.pop()
+            records_num = self._parse_vintage_num(s, 1, low, high)
+            # range (0, 400) also returns wines with no prices, so it is always split
+            is_whole_catalogue = (low, high) == (0, 400)
+            if not is_whole_catalogue and (records_num <= capacity or high - low < 2 * Crawler.MIN_PRICE_STEP):
+                if records_num > capacity:
+                    print(f"Prices from {low} to {high} match {records_num} records, only {capacity} of them "
+                          f"can be downloaded")
+                partitions.append((low, high, records_num))
+            else:
+                middle = round((low + high) / 2, 2)
+                middle = int(middle) if middle == int(middle) else middle
+                ranges_to_check += [(middle, high), (low, middle)]
+
+        partitions.sort()
+        merged = []
+        for low, high, records_num in partitions:
+            # merging must not restore range (0, 400), which would also return wines with no prices
+            if merged and merged[-1][2] + records_num <= capacity and (merged[-1][0], high) != (0, 400):
+                # the sum may count wines priced exactly at the border twice, so it never underestimates
+                merged[-1] = (merged[-1][0], high, merged[-1][2] + records_num)
+            else:
+                merged.append((low, high, records_num))
+        return merged
 
-        if self.verbose:
+    def _price_partitions(self, s, price_min, price_max, with_prices) -> List[tuple]:
+        """
+        Function that returns the price partitions to crawl, including wines with no prices if asked for
+        """
+        partitions = self._partition_prices(s, price_min, price_max)
+        if price_min == 0 and with_prices is not True:  # special case to cover wines with no prices
+            partitions.insert(0, (0, 0, self._parse_vintage_num(s, 1, 0, 0)))
+        return partitions
+
+    def _partition_pages(self, s, low, high, records_num) -> Iterator[List[Dict]]:
+        """
+        Generator that yields every page of wines within a single price partition
+        """
+        capacity = Crawler.EXPLORE_PAGE_CAP * Crawler.EXPLORE_PER_PAGE
+        # to make sure the necessary number of iterations to catch all of the records within a given range:
+        iterations_required = math.ceil(min(records_num, capacity) / Crawler.EXPLORE_PER_PAGE)
+        for it in range(1, iterations_required + 1):
+            yield self._parse_vintages(s, it, low, high)
 
-            records_total = self._parse_vintage_num(s, 1, price_min, price_max)
+    def iter_wine_pages(self, price_min=0, price_max=400, with_prices=True, record_type=None) -> Iterator[List[Dict]]:
+        """
+        Generator that yields pages of wines between min price and max price as soon as they are downloaded.
+        Given a record type (eg. records.Vintage), wines are yielded as compact records instead of raw JSON.
+        """
+        s = requests.Session()
+        s.headers.update(Crawler.SESSION_HEADERS)
+        try:
+            for low, high, records_num in self._price_partitions(s, price_min, price_max, with_prices):
+                for matches in self._partition_pages(s, low, high, records_num):
+                    yield Crawler._as_records(matches, record_type)
+        finally:
+            s.close()
 
-            if price_min == 0 and price_max == 400 and with_prices is True: # remove wines with no prices
-                # here, we remove all records with no prices. Those appear only when range (0, 400) is called
-                records_total -= self._parse_vintage_num(s, 1, 0, 0)
+    def download_all_wines(self, price_min=0, price_max=400, with_prices=True, inter_backup=True, final_backup=True):
+        """
+        Function that splits the range between min price and max price into partitions small enough to be downloaded
+        completely, and extracts all the data within each of them.
+        If necessary, the function may store intermediate backups (dataset match_list) and/or a final backup
+        (dataset full_match_list) as compressed shards in the backup directory.
+        """
+        s = requests.Session()
+        s.headers.update(Crawler.SESSION_HEADERS)
 
-            # elif price_min == 0 and price_max == 400 and with_prices is not True:
-            #     # here, we remove all records with no prices. Those appear only when range (0, 400) is called
-            #     records_total += self._parse_vintage_num(s, 1, 0, 0)
+        partitions = self._price_partitions(s, price_min, price_max, with_prices)
+        capacity = Crawler.EXPLORE_PAGE_CAP * Crawler.EXPLORE_PER_PAGE
 
+        if self.verbose:
+            records_total = sum(records_num for _, _, records_num in partitions)
+            pages_total = sum(math.ceil(min(records_num, capacity) / Crawler.EXPLORE_PER_PAGE)
+                              for _, _, records_num in partitions)
             print(
-                f'''The program recognized app.{records_total} unique records with a price from {price_min} to {price_max} 
-                and will run for app.{math.ceil(records_total / 100)} iterations in total''')
+                f'''The program recognized app.{records_total} records with a price from {price_min} to {price_max} 
+                split into {len(partitions)} price ranges, and will run for app.{pages_total} iterations in total''')
 
         full_wine_list = []
         timepoint_start = time.time()
@@ -132,44 +812,36 @@ class Crawler:
         # define iteration variables
         timepoint_iter = timepoint_start
         cur_batch = []
-
-        # load each price
-        for i in range(price_min, price_max):
-            if i == 0 and with_prices is not True:  # special case to cover wines with no prices
-                cur_price_records_num = self._parse_vintage_num(s, 1, i,
-                                                                i)  # TODO consider the case when iterations exceed 80
-            else:
-                cur_price_records_num = self._parse_vintage_num(s, 1, i, i + 1)
-            # to make sure the necessary number of iterations to catch all of the records with a given price:
-            iterations_required = math.ceil(cur_price_records_num / 100)
-            # load each page of a given price
-            for it in range(1, iterations_required + 1):
-                if i == 0 and with_prices is not True:  # special case to cover wines with no prices
-                    cur_batch += self._parse_vintages(s, 1, i, i)
-                else:
-                    cur_batch += self._parse_vintages(it, i, i + 1)
-                # for every 10th price write intermediate backup, send the results to the main list and update the batch
-                if i % 10 == 0 and it == iterations_required:
-                    if inter_backup:
-                        # piece of code necessary to write intermediate backups in the process
-                        with open(self.backup_dir + f"match_list_{i - 1}", 'wb') as f:
-                            pickle.dump(cur_batch, f)
-                    # append the batch results to the main list
-                    full_wine_list.extend(cur_batch)
-                    cur_batch = []
-
-                    if self.verbose:
-                        time_batch = time.time() - timepoint_iter
-                        print(
-                            f'''Bunch of records with price below {i + 1} uploaded and took {round(time_batch / 60, 2)} minutes. 
-                            Next, running prices from {i + 1}...''')
-                        timepoint_iter = time.time()
-
-            full_wine_list.extend(cur_batch)
-
+        if inter_backup:
+            inter_writer = ShardWriter(self.backup_dir, 'match_list', id_path='vintage/id', overwrite=True)
+
+        # load each price range
+        for index, (low, high, records_num) in enumerate(partitions):
+            # load each page of a given price range
+            for matches in self._partition_pages(s, low, high, records_num):
+                cur_batch += matches
+
+            # for every 10th range write intermediate backup, send the results to the main list and update the batch
+            if (index + 1) % 10 == 0 or index == len(partitions) - 1:
+                if inter_backup:
+                    # piece of code necessary to write intermediate backups in the process
+                    inter_writer.write(cur_batch)
+                # append the batch results to the main list
+                full_wine_list.extend(cur_batch)
+                cur_batch = []
+
+                if self.verbose:
+                    time_batch = time.time() - timepoint_iter
+                    print(
+                        f'''Bunch of records with price up to {high} uploaded and took {round(time_batch / 60, 2)} minutes. 
+                        {index + 1} of {len(partitions)} price ranges are done.''')
+                    timepoint_iter = time.time()
+
+        if inter_backup:
+            inter_writer.close()
         if final_backup:
-            with open(self.backup_dir + "full_match_list", 'wb') as f:
-                pickle.dump(full_wine_list, f)
+            with ShardWriter(self.backup_dir, 'full_match_list', id_path='vintage/id', overwrite=True) as writer:
+                writer.write(full_wine_list)
 
         if self.verbose:
             total_time = time.time() - timepoint_start
@@ -0,0 +1,117 @@
+from typing import List, Dict, Iterable
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from storage import list_shards, _file_checksum
+
+LOAD_STATE = 'load_state.sqlite'
+
+
+def _row_hash(row: tuple) -> str:
+    return hashlib.blake2b(repr(row).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _pk_key(row: tuple, pk_len: int) -> str:
+    return repr(row[:pk_len])
+
+
+class LoadState:
+    """
+    Remembers, in a SQLite file next to the data, which files were loaded to the database (with their checksums) and
+    a hash of every row loaded to every table (by primary key), so that a later run only loads new files, and out of
+    their rows only those which are new to the database or whose content changed since they were loaded.
+    The state is only updated after a file was written to the database, so a failed run loads the same file again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()  # shared by the DB writer threads of insert.py
+        self._conn.execute("CREATE TABLE IF NOT EXISTS loaded_file (name TEXT PRIMARY KEY, checksum TEXT, "
+                           "loaded_at REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS loaded_row (tbl TEXT, pk TEXT, hash TEXT, "
+                           "PRIMARY KEY (tbl, pk)) WITHOUT ROWID")
+        self._conn.commit()
+
+    @staticmethod
+    def file_checksums(dir: str, file_names: Iterable[str]) -> Dict[str, str]:
+        """
+        Function that returns checksums of the given files of a directory: taken from the manifest for shards, and
+        computed for other (eg. pickle) files
+        """
+        shard_checksums = {shard['file']: shard['sha256'] for shard in list_shards(dir)}
+        return {file_name: shard_checksums.get(file_name) or _file_checksum(os.path.join(dir, file_name))
+                for file_name in file_names}
+
+    def is_file_loaded(self, file_name: str, checksum: str) -> bool:
+        with self._lock:
+            loaded = self._conn.execute("SELECT checksum FROM loaded_file WHERE name = ?", (file_name,)).fetchone()
+        return loaded is not None and loaded[0] == checksum
+
+    def _known_hashes(self, table: str, keys: List[str]) -> Dict[str, str]:
+        known = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):  # stays below the limit of SQLite on the number of variables
+                chunk = keys[i:(i + 500)]
+                query = f"SELECT pk, hash FROM loaded_row WHERE tbl = ? AND pk IN ({', '.join('?' * len(chunk))})"
+                known.update(self._conn.execute(query, [table] + chunk).fetchall())
+        return known
+
+    def split_rows(self, table: str, rows: List[tuple], pk_len: int) -> tuple:
+        """
+        Function that compares rows of a table with the rows loaded before
+        :param table: name of the table
+        :param rows: deduplicated rows of the table
+        :param pk_len: number of primary key fields, which come first in every row
+        :return: (new rows, changed rows) tuple; rows loaded before without changes are left out
+        """
+        if pk_len == 0:
+            return rows, []  # without a primary key, rows cannot be matched with the loaded ones
+        known = self._known_hashes(table, [_pk_key(row, pk_len) for row in rows])
+        new_rows, changed_rows = [], []
+        for row in rows:
+            known_hash = known.get(_pk_key(row, pk_len))
+            if known_hash is None:
+                new_rows.append(row)
+            elif known_hash != _row_hash(row):
+                changed_rows.append(row)
+        return new_rows, changed_rows
+
+    def record_file(self, file_name: str, checksum: str, rows: Dict[str, List[tuple]], pk_lens: Dict[str, int]) -> None:
+        """
+        Function that records a file and the hashes of its rows once they were written to the database
+        :param file_name: name of the file
+        :param checksum: checksum of the file, see file_checksums
+        :param rows: dictionary mapping table names to the rows written
+        :param pk_lens: dictionary mapping table names to the number of primary key fields
+        """
+        with self._lock:
+            for table, table_rows in rows.items():
+                if pk_lens[table] > 0:
+                    self._conn.executemany("INSERT OR REPLACE INTO loaded_row VALUES (?, ?, ?)",
+                                           [(table, _pk_key(row, pk_lens[table]), _row_hash(row))
+                                            for row in table_rows])
+            self._conn.execute("INSERT OR REPLACE INTO loaded_file VALUES (?, ?, ?)",
+                               (file_name, checksum, time.time()))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        """
+        Function that forgets everything loaded before, eg. when the tables are cleaned
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM loaded_file")
+            self._conn.execute("DELETE FROM loaded_row")
+            self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,272 @@
+from typing import List, Dict, Iterable
+import argparse
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset
+import pyarrow.parquet as pq
+from storage import list_shards, read_dataset, get_value
+from idset import iter_unique
+
+# checksums of the shards every Parquet dataset was exported from, kept in its root directory
+EXPORT_SOURCES = '_sources.json'  # files starting with _ are ignored by Parquet readers
+
+# (path inside the JSON record, Arrow type) for every exported column; columns are named like pd.json_normalize does
+WINE_COLUMNS = [
+    ('vintage/id', pa.int64()),
+    ('vintage/name', pa.string()),
+    ('vintage/seo_name', pa.string()),
+    ('vintage/has_valid_ratings', pa.bool_()),
+    ('vintage/statistics/status', pa.string()),
+    ('vintage/statistics/ratings_count', pa.int64()),
+    ('vintage/statistics/ratings_average', pa.float64()),
+    ('vintage/statistics/labels_count', pa.int64()),
+    ('vintage/wine/id', pa.int64()),
+    ('vintage/wine/name', pa.string()),
+    ('vintage/wine/seo_name', pa.string()),
+    ('vintage/wine/type_id', pa.int64()),
+    ('vintage/wine/vintage_type', pa.int64()),
+    ('vintage/wine/is_natural', pa.bool_()),
+    ('vintage/wine/region/id', pa.int64()),
+    ('vintage/wine/region/name', pa.string()),
+    ('vintage/wine/region/country/code', pa.string()),
+    ('vintage/wine/winery/id', pa.int64()),
+    ('vintage/wine/winery/name', pa.string()),
+    ('vintage/wine/style/id', pa.int64()),
+    ('vintage/wine/style/name', pa.string()),
+    ('vintage/wine/style/body', pa.int64()),
+    ('vintage/wine/style/acidity', pa.int64()),
+    ('vintage/wine/taste/structure/acidity', pa.float64()),
+    ('vintage/wine/taste/structure/fizziness', pa.float64()),
+    ('vintage/wine/taste/structure/intensity', pa.float64()),
+    ('vintage/wine/taste/structure/sweetness', pa.float64()),
+    ('vintage/wine/taste/structure/tannin', pa.float64()),
+    ('vintage/wine/statistics/ratings_count', pa.int64()),
+    ('vintage/wine/statistics/ratings_average', pa.float64()),
+    ('vintage/wine/statistics/labels_count', pa.int64()),
+    ('vintage/wine/statistics/vintages_count', pa.int64()),
+    ('price/id', pa.int64()),
+    ('price/amount', pa.float64()),
+    ('price/discounted_from', pa.float64()),
+    ('price/currency/code', pa.string()),
+    ('price/bottle_type/name', pa.string()),
+]
+
+REVIEW_COLUMNS = [
+    ('id', pa.int64()),
+    ('rating', pa.float64()),
+    ('note', pa.string()),
+    ('language', pa.string()),
+    ('created_at', pa.string()),
+    ('aggregated', pa.bool_()),
+    ('user/id', pa.int64()),
+    ('user/alias', pa.string()),
+    ('user/seo_name', pa.string()),
+    ('user/is_featured', pa.bool_()),
+    ('user/statistics/followers_count', pa.int64()),
+    ('user/statistics/followings_count', pa.int64()),
+    ('user/statistics/ratings_count', pa.int64()),
+    ('user/statistics/reviews_count', pa.int64()),
+    ('activity/id', pa.int64()),
+    ('activity/statistics/likes_count', pa.int64()),
+    ('activity/statistics/comments_count', pa.int64()),
+    ('vintage/id', pa.int64()),
+    ('vintage/wine/id', pa.int64()),
+]
+
+
+def _column_name(path: str) -> str:
+    return path.replace('/', '.')
+
+
+def _schema(columns: List[tuple]) -> pa.Schema:
+    return pa.schema([(_column_name(path), arrow_type) for path, arrow_type in columns])
+
+
+class PartitionedParquetWriter:
+    """
+    Writes rows to a Parquet dataset partitioned by country and year (directories country=X/year=Y), with one file
+    per source dataset in every partition, so that exporting the same dataset again replaces its files.
+    Rows are buffered per partition and flushed as row groups of up to row_group_size rows.
+    """
+
+    def __init__(self, root: str, columns: List[tuple], file_name: str, row_group_size=100000):
+        self.root = root
+        self.columns = columns
+        self.schema = _schema(columns)
+        self.file_name = file_name
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+        self._buffers = {}
+        self._writers = {}
+
+    def write(self, country: str, year: any, record: Dict) -> None:
+        """
+        Function that adds a single JSON record to the partition of a given country and year
+        """
+        partition = (str(country), str(year))
+        buffer = self._buffers.setdefault(partition, [])
+        buffer.append([get_value(record, path) for path, _ in self.columns])
+        if len(buffer) >= self.row_group_size:
+            self._flush(partition)
+
+    def _flush(self, partition: tuple) -> None:
+        rows = self._buffers.pop(partition, [])
+        if not rows:
+            return
+        arrays = [pa.array([row[i] for row in rows], type=arrow_type)
+                  for i, (_, arrow_type) in enumerate(self.columns)]
+        if partition not in self._writers:
+            country, year = partition
+            directory = os.path.join(self.root, f"country={country}", f"year={year}")
+            os.makedirs(directory, exist_ok=True)
+            self._writers[partition] = pq.ParquetWriter(os.path.join(directory, self.file_name), self.schema)
+        self._writers[partition].write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows_written += len(rows)
+
+    def close(self) -> None:
+        for partition in list(self._buffers):
+            self._flush(partition)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def _read_sources(parquet_dir: str) -> Dict[str, List[str]]:
+    path = os.path.join(parquet_dir, EXPORT_SOURCES)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _record_source(parquet_dir: str, dataset: str, checksums: List[str] = None) -> None:
+    """
+    Function that records the checksums of the shards a dataset was exported from, or forgets them if None
+    """
+    sources = _read_sources(parquet_dir)
+    if checksums is None:
+        sources.pop(dataset, None)
+    else:
+        sources[dataset] = checksums
+    os.makedirs(parquet_dir, exist_ok=True)
+    path = os.path.join(parquet_dir, EXPORT_SOURCES)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(sources, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _shard_checksums(backup_dir: str, dataset: str) -> List[str]:
+    return [shard['sha256'] for shard in list_shards(backup_dir, dataset)]
+
+
+def is_export_current(backup_dir: str, parquet_dir: str, dataset='full_match_list') -> bool:
+    """
+    Function that tells whether a dataset was exported to Parquet from the shards it currently has in the manifest
+    :param backup_dir: directory with the shards of the dataset
+    :param parquet_dir: root directory of the Parquet dataset
+    :param dataset: name of the dataset
+    :return: False if the dataset was never exported, or was crawled again since
+    """
+    return _read_sources(parquet_dir).get(dataset) == _shard_checksums(backup_dir, dataset)
+
+
+def _remove_exported(parquet_dir: str, file_name: str) -> None:
+    """
+    Function that deletes the files exported from a dataset in all partitions, so that partitions the dataset no
+    longer has do not keep old rows
+    """
+    for directory, _, file_names in os.walk(parquet_dir):
+        if file_name in file_names:
+            os.remove(os.path.join(directory, file_name))
+
+
+def export_wines(backup_dir: str, parquet_dir: str, dataset='full_match_list') -> int:
+    """
+    Function that flattens the wine dataset shard by shard and writes it to Parquet partitioned by country and year,
+    skipping duplicated vintages
+    :param backup_dir: directory with the shards of wine data
+    :param parquet_dir: root directory of the Parquet dataset with wines
+    :param dataset: name of the dataset with wine data
+    :return: number of exported vintages
+    """
+    checksums = _shard_checksums(backup_dir, dataset)
+    _record_source(parquet_dir, dataset, None)  # an interrupted export is never taken for a current one
+    _remove_exported(parquet_dir, f"{dataset}.parquet")
+    with PartitionedParquetWriter(parquet_dir, WINE_COLUMNS, f"{dataset}.parquet") as writer:
+        for record in iter_unique(read_dataset(backup_dir, dataset), lambda record: get_value(record, 'vintage/id')):
+            writer.write(get_value(record, 'vintage/wine/region/country/name'),
+                         get_value(record, 'vintage/year'), record)
+    _record_source(parquet_dir, dataset, checksums)
+    return writer.rows_written
+
+
+def export_reviews(backup_dir: str, parquet_dir: str, country: str, year: any) -> int:
+    """
+    Function that flattens the reviews of a given country and year shard by shard and writes them to the matching
+    partition of the Parquet dataset with reviews, skipping duplicated reviews
+    :param backup_dir: directory with the shards of review data
+    :param parquet_dir: root directory of the Parquet dataset with reviews
+    :param country: Country name for the batch of reviews
+    :param year: Year for the batch of reviews
+    :return: number of exported reviews
+    """
+    with PartitionedParquetWriter(parquet_dir, REVIEW_COLUMNS, f"{country}_{year}.parquet") as writer:
+        for record in iter_unique(read_dataset(backup_dir, f"{country}_{year}"), lambda record: record['id']):
+            writer.write(country, year, record)
+    return writer.rows_written
+
+
+def _partition_filters(countries: Iterable[str] = None, years: Iterable = None) -> List[tuple]:
+    filters = []
+    if countries is not None:
+        filters.append(('country', 'in', [str(country) for country in countries]))
+    if years is not None:
+        filters.append(('year', 'in', [str(year) for year in years]))
+    return filters or None
+
+
+def read_parquet(parquet_dir: str, columns: List[str] = None, countries: Iterable[str] = None,
+                 years: Iterable = None) -> pd.DataFrame:
+    """
+    Function that reads only the requested columns and country/year partitions of an exported Parquet dataset
+    :param parquet_dir: root directory of the Parquet dataset
+    :param columns: flattened column names, eg. 'vintage.wine.id'; all columns if None
+    :param countries: country names to read; all countries if None
+    :param years: years to read; all years if None
+    :return: Pandas DataFrame; columns country and year hold strings, as in the directory names
+    """
+    dataset = pq.ParquetDataset(parquet_dir, filters=_partition_filters(countries, years),
+                                partitioning=pa.dataset.partitioning(
+                                    pa.schema([('country', pa.string()), ('year', pa.string())]), flavor='hive'))
+    return dataset.read(columns=columns).to_pandas()
+
+
+if __name__ == "__main__":
+    """
+    Usage: python export.py [-h] [-p PATH] [-o OUTPUT]
+    """
+
+    parser = argparse.ArgumentParser(description='Export crawled wines and reviews to Parquet')
+    parser.add_argument("-p", "--path", help="path to the backup data", default="backup_data/")
+    parser.add_argument("-o", "--output", help="path to write Parquet datasets to", default="parquet/")
+    args = parser.parse_args()
+
+    backup_dir = args.path
+    parquet_dir = args.output
+
+    if len(list_shards(backup_dir, 'full_match_list')) > 0:
+        print(f"Exported {export_wines(backup_dir, parquet_dir + 'wines/')} vintages")
+    review_datasets = sorted({shard['dataset'] for shard in list_shards(backup_dir + 'reviews/')})
+    for review_dataset in review_datasets:
+        country, year = review_dataset.rsplit('_', 1)
+        print(f"Exported {export_reviews(backup_dir + 'reviews/', parquet_dir + 'reviews/', country, year)} "
+              f"reviews on {country} in {year}")
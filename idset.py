@@ -0,0 +1,194 @@
+from typing import List, Dict, Iterable, Iterator, Callable
+from array import array
+from bisect import bisect_left
+import os
+import sqlite3
+import tempfile
+
+
+class IntBitmap:
+    """
+    Set of non-negative integers split in pages of 65536 consecutive values, as roaring bitmaps do: a page holds a
+    sorted array of its values (2 bytes each) while it has few of them, and turns into a bitmap of 8 Kb once that is
+    smaller. Memory follows the number of values rather than the largest one, eg. 12 Mb for all ids up to 100
+    millions, and a few bytes per id for ids spread far apart.
+    """
+    PAGE_SIZE = 1 << 16
+    ARRAY_MAX = 4096  # an array page of more values would take more memory than a bitmap page
+
+    def __init__(self):
+        self._pages = {}
+        self.size = 0
+
+    def add(self, value: int) -> bool:
+        """
+        Function that adds a value to the set and tells whether it was not there before
+        """
+        page_key, low = value >> 16, value & 0xFFFF
+        page = self._pages.get(page_key)
+        if page is None:
+            self._pages[page_key] = array('H', (low,))
+        elif type(page) is bytearray:
+            byte, bit = low >> 3, 1 << (low & 7)
+            if page[byte] & bit:
+                return False
+            page[byte] |= bit
+        else:
+            position = bisect_left(page, low)
+            if position < len(page) and page[position] == low:
+                return False
+            if len(page) < IntBitmap.ARRAY_MAX:
+                page.insert(position, low)
+            else:
+                self._pages[page_key] = IntBitmap._to_bitmap(page, low)
+        self.size += 1
+        return True
+
+    @staticmethod
+    def _to_bitmap(page: array, low: int) -> bytearray:
+        bits = bytearray(IntBitmap.PAGE_SIZE >> 3)
+        for value in page:
+            bits[value >> 3] |= 1 << (value & 7)
+        bits[low >> 3] |= 1 << (low & 7)
+        return bits
+
+
+class IdSet:
+    """
+    Set of record ids: non-negative integers go to an IntBitmap, anything else to a Python set
+    """
+
+    def __init__(self):
+        self._ints = IntBitmap()
+        self._others = set()
+
+    def __len__(self) -> int:
+        return self._ints.size + len(self._others)
+
+    def add(self, value: any) -> bool:
+        """
+        Function that adds an id to the set and tells whether it was not there before
+        """
+        if type(value) is int and value >= 0:
+            return self._ints.add(value)
+        if value in self._others:
+            return False
+        self._others.add(value)
+        return True
+
+
+def dedup_in_place(records: List[Dict], get_id: Callable[[Dict], any]) -> List[Dict]:
+    """
+    Function that removes records with repeated ids from a list, keeping the first occurrence of every id. The list
+    is compacted in place, so no copy of it (nor a dictionary of all records) is built along the way.
+    :param records: list of records, modified in place
+    :param get_id: function returning the id of a record
+    :return: the same list, without duplicates
+    """
+    seen = IdSet()
+    kept = 0
+    for record in records:
+        if seen.add(get_id(record)):
+            records[kept] = record
+            kept += 1
+    del records[kept:]
+    return records
+
+
+def iter_unique(records: Iterable[Dict], get_id: Callable[[Dict], any], seen: IdSet = None) -> Iterator[Dict]:
+    """
+    Generator that yields records whose id was not yielded before, keeping the first occurrence of every id, eg. over
+    all shards of a dataset read one record at a time
+    :param records: iterable over records
+    :param get_id: function returning the id of a record
+    :param seen: ids to skip, shared between several calls; a new set if None
+    :return: iterator over unique records
+    """
+    seen = seen if seen is not None else IdSet()
+    for record in records:
+        if seen.add(get_id(record)):
+            yield record
+
+
+class KeySet:
+    """
+    Set of primary keys seen during a run. Keys made of a single whole number go to an IntBitmap; other keys (codes,
+    composite keys) go to a Python set, which is moved to a temporary SQLite file once it holds more than
+    max_keys_in_memory keys, if spill_dir is given.
+    """
+
+    def __init__(self, spill_dir: str = None, max_keys_in_memory=5000000):
+        self.spill_dir = spill_dir
+        self.max_keys_in_memory = max_keys_in_memory
+        self._ints = IntBitmap()
+        self._keys = set()
+        self._spill = None
+        self._spill_path = None
+
+    def __len__(self) -> int:
+        spilled = self._spill.execute("SELECT COUNT(*) FROM seen").fetchone()[0] if self._spill is not None else 0
+        return self._ints.size + len(self._keys) + spilled
+
+    def add(self, key: tuple) -> bool:
+        """
+        Function that adds a primary key to the set and tells whether it was not there before
+        :param key: values of the primary key fields, eg. (12.0,); numbers are floats after Inserter._format_numbers
+        :return: True if the key is new
+        """
+        if len(key) == 1 and isinstance(key[0], (int, float)) and not isinstance(key[0], bool) \
+                and key[0] >= 0 and key[0] == int(key[0]):
+            return self._ints.add(int(key[0]))
+        if self._spill is not None:
+            cur = self._spill.execute("INSERT OR IGNORE INTO seen VALUES (?)", (repr(key),))
+            return cur.rowcount == 1
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        if self.spill_dir is not None and len(self._keys) > self.max_keys_in_memory:
+            self._spill_to_disk()
+        return True
+
+    def _spill_to_disk(self) -> None:
+        handle, self._spill_path = tempfile.mkstemp(suffix='.sqlite', dir=self.spill_dir)
+        os.close(handle)
+        self._spill = sqlite3.connect(self._spill_path, isolation_level=None)
+        self._spill.execute("PRAGMA journal_mode = OFF")
+        self._spill.execute("PRAGMA synchronous = OFF")
+        self._spill.execute("CREATE TABLE seen (key TEXT PRIMARY KEY) WITHOUT ROWID")
+        self._spill.execute("BEGIN")
+        self._spill.executemany("INSERT INTO seen VALUES (?)", ((repr(key),) for key in self._keys))
+        self._spill.execute("COMMIT")
+        self._keys = set()
+
+    def filter_new(self, rows: List[tuple], pk_len: int) -> List[tuple]:
+        """
+        Function that keeps the rows whose primary key was not seen before, and marks their keys as seen
+        :param rows: rows of a table
+        :param pk_len: number of primary key fields, which come first in every row; all rows are kept if 0
+        :return: list of rows with new primary keys
+        """
+        if pk_len == 0:
+            return rows
+        add = self.add
+        return [row for row in rows if add(row[:pk_len])]
+
+    def split_new(self, rows: List[tuple], pk_len: int) -> tuple:
+        """
+        Function that splits rows like filter_new, but also returns the rows whose primary key was seen before
+        :param rows: rows of a table
+        :param pk_len: number of primary key fields, which come first in every row; all rows are new if 0
+        :return: (rows with new primary keys, rows with primary keys seen before) tuple
+        """
+        if pk_len == 0:
+            return rows, []
+        new_rows, seen_rows = [], []
+        add = self.add
+        for row in rows:
+            (new_rows if add(row[:pk_len]) else seen_rows).append(row)
+        return new_rows, seen_rows
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            os.remove(self._spill_path)
+            self._spill = None
@@ -1,9 +1,21 @@
 import argparse
 import os, sys
+import re
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 from inserters import *
 import mariadb
 import settings
 import pickle
+from storage import list_shards, read_shard, is_shard_file, is_manifest_file
+from delta import LOAD_STATE, LoadState
+from idset import KeySet
+import tempfile
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
 
 
 def connect_to_vivino_db(): #TODO type annot
@@ -16,41 +28,392 @@ def connect_to_vivino_db(): #TODO type annot
                 password=settings.db_pass,
                 host=settings.db_url,
                 port=3306,
-                database="vivino")
+                database="vivino",
+                local_infile=True)  # needed by inserters loading with LOAD DATA LOCAL INFILE
     except mariadb.Error as e:
         print(f"Error connecting to MariaDB Platform: {e}")
         raise e
     return conn
 
 
-def read_files_insert_to_sql(dir: str, inserters: List[Inserter], clean_first: bool, verbose: bool) -> None:
-    if clean_first:
-        for inserter in reversed(inserters):
-            conn = connect_to_vivino_db()
+class ConnectionPool:
+    """
+    Keeps up to size open connections to the database and hands them out to the inserters, so that a run pays for
+    the handshake with the server once per connection rather than once per file and table. A connection is checked
+    with a ping before it is handed out and is replaced by a new one if it dropped in the meantime, or if it failed
+    while in use.
+    """
+
+    def __init__(self, size=settings.db_pool_size, connect=connect_to_vivino_db):
+        self.size = size
+        self._connect = connect
+        self._idle = []  # used as a stack: the most recently used connection is the least likely to have timed out
+        self._opened = 0
+        # notified whenever a connection is given back or discarded, so that a waiting caller can take it or open
+        # a new one in its place
+        self._available = threading.Condition()
+
+    def _checkout(self):
+        while True:
+            with self._available:
+                while len(self._idle) == 0 and self._opened >= self.size:
+                    self._available.wait()
+                if len(self._idle) > 0:
+                    conn = self._idle.pop()
+                else:
+                    conn = None
+                    self._opened += 1
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._release()
+                    raise
             try:
+                conn.ping()
+                return conn
+            except mariadb.Error:
+                print("Connection to MariaDB Platform lost, reconnecting...")
+                self._discard(conn)
+
+    def _checkin(self, conn) -> None:
+        with self._available:
+            self._idle.append(conn)
+            self._available.notify()
+
+    def _release(self) -> None:
+        with self._available:
+            self._opened -= 1
+            self._available.notify()
+
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except mariadb.Error:
+            pass
+        self._release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that borrows a connection from the pool and gives it back afterwards; uncommitted changes are
+        rolled back if the block fails, and the connection is closed if it is broken
+        """
+        conn = self._checkout()
+        try:
+            yield conn
+        except mariadb.Error:
+            self._discard(conn)
+            raise
+        except BaseException:
+            conn.rollback()
+            self._checkin(conn)
+            raise
+        else:
+            self._checkin(conn)
+
+    def close(self) -> None:
+        with self._available:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def list_input_files(dir: str) -> List[tuple]:
+    """
+    Function that lists units of data to be inserted from a directory: shards listed in its manifests, followed by
+    legacy pickle files, if any. Shard files missing from the manifests (left behind by an interrupted crawl) are
+    skipped.
+    :param dir: directory with backup data
+    :return: list of (name, function loading the records) tuples; the functions can be sent to other processes
+    """
+    shards = list_shards(dir)
+    units = [(shard['file'], partial(_load_shard, dir, shard)) for shard in shards]
+    for file_name in sorted(os.listdir(dir)):
+        if file_name.startswith(".") or os.path.isdir(os.path.join(dir, file_name)) \
+                or is_shard_file(file_name) or is_manifest_file(file_name) \
+                or file_name.startswith(('crawl_journal', LOAD_STATE)):
+            continue
+        units.append((file_name, partial(_load_pickle, os.path.join(dir, file_name))))
+    return units
+
+
+def _load_shard(dir: str, shard: Dict) -> List[Dict]:
+    return list(read_shard(dir, shard))
+
+
+def _load_pickle(path: str) -> List[Dict]:
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def read_foreign_keys(schema_path=SCHEMA_PATH) -> Dict[str, set]:
+    """
+    Function that finds the tables referenced by foreign keys of every table defined in a schema file
+    :param schema_path: path to the file with CREATE TABLE statements
+    :return: dictionary mapping table names to sets of referenced table names
+    """
+    foreign_keys = {}
+    table = None
+    with open(schema_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            match = re.match(r'\s*create table (\w+)', line, re.IGNORECASE)
+            if match:
+                table = match.group(1)
+                foreign_keys[table] = set()
+            for referenced in re.findall(r'references (\w+)', line, re.IGNORECASE):
+                foreign_keys[table].add(referenced)
+    return foreign_keys
+
+
+def inserter_dependencies(inserters: List[Inserter], foreign_keys: Dict[str, set]) -> Dict[str, set]:
+    """
+    Function that returns, for every inserter, the tables among the given inserters which have to be loaded before
+    it: those referenced by its foreign keys, as well as those it declares in DEPENDS_ON
+    """
+    tables = {inserter.table for inserter in inserters}
+    return {inserter.table: ((foreign_keys.get(inserter.table, set()) | set(inserter.DEPENDS_ON)) & tables)
+            - {inserter.table} for inserter in inserters}
+
+
+def _insert_table(pool: ConnectionPool, inserter: Inserter, args: List[tuple], verbose: bool,
+                  changed_args: List[tuple] = None) -> None:
+    with pool.connection() as conn:
+        print(f"Loading {len(args)} rows to {inserter.table}...")
+        inserter.insert_rows(conn, args, verbose)
+        if changed_args:
+            inserter.update_rows(conn, changed_args, verbose)
+
+
+def insert_rows_to_sql(rows: Dict[str, List[tuple]], inserters: List[Inserter], dependencies: Dict[str, set],
+                       pool: ConnectionPool, verbose: bool, changed_rows: Dict[str, List[tuple]] = None) -> None:
+    """
+    Function that loads extracted rows of every table, running as many inserters at a time as there are connections
+    in the pool. An inserter is started as soon as all tables it depends on are loaded.
+    :param rows: dictionary mapping table names to rows, eg. from MultiTableExtractor
+    :param inserters: inserters of the tables
+    :param dependencies: dictionary mapping table names to tables to be loaded first, see inserter_dependencies
+    :param pool: pool of connections to the database
+    :param verbose: boolean if asked to print the progress of loading
+    :param changed_rows: dictionary mapping table names to rows overwriting the existing records, see LoadState
+    :return: None
+    """
+    changed_rows = changed_rows or {}
+    pending = list(inserters)
+    loaded = set()
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        running = {}
+        while pending or running:
+            ready = [inserter for inserter in pending if dependencies[inserter.table] <= loaded]
+            for inserter in ready:
+                pending.remove(inserter)
+                running[executor.submit(_insert_table, pool, inserter, rows[inserter.table], verbose,
+                                        changed_rows.get(inserter.table))] = inserter
+            if not running:
+                raise ValueError(f"Circular dependencies between tables {[inserter.table for inserter in pending]}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                inserter = running.pop(future)
+                future.result()  # raises the error of a failed inserter
+                loaded.add(inserter.table)
+
+
+_extractor = None  # MultiTableExtractor of an extraction process, see _init_extraction_process
+
+
+def _init_extraction_process(inserters: List[Inserter]) -> None:
+    global _extractor
+    _extractor = MultiTableExtractor(inserters)
+
+
+def _extract_file(file_name: str, load_records: Callable[[], List[Dict]]) -> tuple:
+    """
+    Function that loads a file and extracts its rows for all tables, in an extraction process
+    :return: (file name, number of records, dictionary mapping table names to rows) tuple
+    """
+    cur_data = load_records()
+    return file_name, len(cur_data), _extractor.extract(cur_data)
+
+
+def iter_extracted_files(file_list: List[tuple], inserters: List[Inserter], extract_workers: int) -> Iterator[tuple]:
+    """
+    Generator that loads files and extracts their rows for all tables, with up to extract_workers files extracted in
+    parallel processes. Files are yielded as soon as they are extracted, and a new file is only started once a file
+    is consumed, so that no more than extract_workers extracted files wait in memory.
+    :param file_list: list of (name, function loading the records) tuples, see list_input_files
+    :param inserters: inserters of the tables
+    :param extract_workers: number of processes; files are extracted one by one in the current process if 1
+    :return: iterator over (file name, number of records, dictionary mapping table names to rows) tuples
+    """
+    if extract_workers <= 1:
+        extractor = MultiTableExtractor(inserters)
+        for file_name, load_records in file_list:
+            # every file is read and walked only once, and its rows for all tables are extracted in the same pass
+            cur_data = load_records()
+            yield file_name, len(cur_data), extractor.extract(cur_data)
+            del cur_data
+        return
+    files = iter(file_list)
+    with ProcessPoolExecutor(max_workers=extract_workers, initializer=_init_extraction_process,
+                             initargs=(inserters,)) as executor:
+        running = set()
+        while True:
+            for file_name, load_records in files:
+                running.add(executor.submit(_extract_file, file_name, load_records))
+                if len(running) >= extract_workers:
+                    break
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()
+
+
+def _write_extracted_files(files: queue.Queue, inserters: List[Inserter], dependencies: Dict[str, set],
+                           pool: ConnectionPool, verbose: bool, errors: List[Exception],
+                           state: LoadState = None) -> None:
+    """
+    Function run by a DB writer thread: loads extracted files from the queue until it gets None. After an error, the
+    remaining files are only taken from the queue, so that the reading side never waits forever.
+    """
+    while True:
+        extracted = files.get()
+        if extracted is None:
+            break
+        if errors:
+            continue
+        file_name, records_num, rows, changed_rows, checksum = extracted
+        try:
+            print(f"Loading rows of {records_num} records from file {file_name}...")
+            insert_rows_to_sql(rows, inserters, dependencies, pool, verbose, changed_rows)
+            if state is not None:
+                state.record_file(file_name, checksum,
+                                  {table: table_rows + changed_rows.get(table, []) for table, table_rows in rows.items()},
+                                  {inserter.table: len(inserter.pk_sql) for inserter in inserters})
+        except Exception as e:
+            errors.append(e)
+
+
+def _load_files(dir: str, inserters: List[Inserter], pool: ConnectionPool, verbose: bool, extract_workers: int,
+                writers: int, queue_size: int, state: LoadState, update_changed: bool, dedup: bool) -> None:
+    dependencies = inserter_dependencies(inserters, read_foreign_keys())
+    file_list = list_input_files(dir)
+    checksums = {}
+    if state is not None:
+        # files loaded before with the same content are not even read
+        checksums = LoadState.file_checksums(dir, [file_name for file_name, _ in file_list])
+        file_list = [(file_name, load_records) for file_name, load_records in file_list
+                     if not state.is_file_loaded(file_name, checksums[file_name])]
+        print(f"{len(file_list)} new or modified files to load")
+    # keys sent to the database during this run, per table; rows of later files with the same keys are not sent again.
+    # Files must then be written in order, or a file could refer to rows still waiting to be written by another writer
+    seen = {inserter.table: KeySet(spill_dir=tempfile.gettempdir()) for inserter in inserters} \
+        if dedup and writers == 1 else None
+    files = queue.Queue(maxsize=queue_size)
+    errors = []
+    threads = [threading.Thread(target=_write_extracted_files,
+                                args=(files, inserters, dependencies, pool, verbose, errors, state))
+               for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i, (file_name, records_num, rows) in enumerate(iter_extracted_files(file_list, inserters,
+                                                                                extract_workers)):
+            print(f"Extracted {records_num} records from file {file_name} (file {i+1} of {len(file_list)})")
+            changed_rows = {}
+            if state is not None:
+                # rows loaded before are left out, and changed ones only kept if they are to be updated
+                for inserter in inserters:
+                    rows[inserter.table], changed = state.split_rows(inserter.table, rows[inserter.table],
+                                                                     len(inserter.pk_sql))
+                    if update_changed:
+                        changed_rows[inserter.table] = changed
                 if verbose:
-                    inserter.count_records(conn, 'Before cleaning')
-                inserter.clean_table(conn)
-            finally:
-                conn.close()
-    for inserter in inserters:
-        print(f"Loading to {inserter.table}...")
-        file_list = os.listdir(dir)
-        for i in range(len(file_list)):
-            if file_list[i].startswith(".") or os.path.isdir(os.path.join(dir, file_list[i])):
-                pass
-            else:
-                with open(f'{dir}{file_list[i]}', 'rb') as f:
-                    cur_data = pickle.load(f)
-                    print(f"Loading {len(cur_data)} records from file {file_list[i]} (file {i+1} of {len(file_list)})...")
-                conn = connect_to_vivino_db()
-                try:
-                    inserter.insert(conn, cur_data, verbose)
-                finally:
-                    conn.close()
+                    print(f"{sum(len(table_rows) for table_rows in rows.values())} new and "
+                          f"{sum(len(table_rows) for table_rows in changed_rows.values())} changed rows to load")
+            if seen is not None:
+                # only new rows are filtered: changed ones are always sent. The state only knows the rows of a file
+                # once it was written, so a key sent by an earlier file of this run may still look new; when changed
+                # rows are updated, such rows are sent as updates too instead of being dropped
+                rows_num = sum(len(table_rows) for table_rows in rows.values())
+                for inserter in inserters:
+                    rows[inserter.table], repeated = seen[inserter.table].split_new(rows[inserter.table],
+                                                                                    len(inserter.pk_sql))
+                    if update_changed and repeated:
+                        changed_rows[inserter.table] = changed_rows.get(inserter.table, []) + repeated
+                if verbose:
+                    print(f"{rows_num - sum(len(table_rows) for table_rows in rows.values())} rows were already sent "
+                          f"from previous files" + (", sent as updates" if update_changed else ""))
+            files.put((file_name, records_num, rows, changed_rows, checksums.get(file_name)))
+            if errors:
+                break
+    finally:
+        for _ in threads:
+            files.put(None)
+        for thread in threads:
+            thread.join()
+        for key_set in (seen or {}).values():
+            key_set.close()
+    if errors:
+        raise errors[0]
 
 
+def read_files_insert_to_sql(dir: str, inserters: List[Inserter], clean_first: bool, verbose: bool,
+                             load_mode: str = None, workers: int = None, extract_workers=1, writers=1,
+                             queue_size=2, state_path: str = None, update_changed=False, dedup=True) -> None:
+    """
+    Function that loads all files of a directory into SQL. Files are read and extracted (by extract_workers processes)
+    while previously extracted files are written to the database (by writers threads), and at most queue_size
+    extracted files wait in between, which bounds the memory used.
+    :param dir: directory with backup data
+    :param inserters: inserters of the tables, see insert_rows_to_sql
+    :param clean_first: whether to delete all records of the tables first
+    :param verbose: boolean if asked to print the progress of loading
+    :param load_mode: load mode of all tables, see Inserter.LOAD_MODES; each inserter's own if None
+    :param workers: number of connections to the database, settings.db_pool_size if None
+    :param extract_workers: number of processes reading and extracting files
+    :param writers: number of files written to the database at the same time
+    :param queue_size: maximum number of extracted files waiting to be written
+    :param state_path: path to the LoadState of the database; if given, only files and rows which were not loaded
+    before are loaded
+    :param update_changed: whether to overwrite records whose rows changed since they were loaded (needs state_path)
+    :param dedup: whether to send every primary key of a table only once per run, see KeySet; needs writers == 1
+    :return: None
+    """
+    if load_mode is not None:
+        # eg. 'staging' to keep the live tables unlocked while the data is loaded, see Inserter.LOAD_MODES
+        for inserter in inserters:
+            inserter.load_mode = load_mode
+    # connections are opened lazily and reused by all files and tables, workers is the size of the pool
+    with ConnectionPool(workers or settings.db_pool_size) as pool:
+        if clean_first:
+            for inserter in reversed(inserters):
+                with pool.connection() as conn:
+                    if verbose:
+                        inserter.count_records(conn, 'Before cleaning')
+                    inserter.clean_table(conn)
+        state = LoadState(state_path) if state_path is not None else None
+        try:
+            if state is not None and clean_first:
+                state.clear()
+            _load_files(dir, inserters, pool, verbose, extract_workers, writers, queue_size, state, update_changed,
+                        dedup)
+        finally:
+            if state is not None:
+                state.close()
+
     print("Loading complete.")
+    if verbose:
+        # loading is verified once per run, from the numbers of rows the database reported as inserted
+        for inserter in inserters:
+            inserter.report_loaded_rows()
 
 
 if __name__ == '__main__':
@@ -65,6 +428,13 @@ if __name__ == '__main__':
     # parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
     # parser.add_argument("-c", "--clean", help="cleans table before inserting", action="store_true")
     # parser.add_argument("-p", "--path", help="path to load data", default="backup_data/")
+    # parser.add_argument("-m", "--mode", help="load mode of all tables", choices=Inserter.LOAD_MODES)
+    # parser.add_argument("-j", "--jobs", help="number of tables loaded concurrently", type=int,
+    #                     default=settings.db_pool_size)
+    # parser.add_argument("-e", "--extract-workers", help="number of processes extracting files", type=int, default=2)
+    # parser.add_argument("-W", "--writers", help="number of files written to SQL at once", type=int, default=1)
+    # parser.add_argument("-d", "--delta", help="only load files and rows not loaded before", action="store_true")
+    # parser.add_argument("-u", "--update", help="with --delta, update rows which changed", action="store_true")
     #
     # args = parser.parse_args()
     #
@@ -73,12 +443,24 @@ if __name__ == '__main__':
     # verbose = args.verbose
     # clean_first = args.clean
     # backup_dir = args.path
+    # load_mode = args.mode
+    # workers = args.jobs
+    # extract_workers = args.extract_workers
+    # writers = args.writers
+    # delta = args.delta
+    # update_changed = args.update
 
     store_wines = False
     store_reviews = True
     verbose = True
     clean_first = False
     backup_dir = "backup_data/reviews/France/"
+    load_mode = None  # each inserter's own load mode
+    workers = settings.db_pool_size
+    extract_workers = 2
+    writers = 1
+    delta = False  # only load files and rows missing from load_state.sqlite, see -d/--delta
+    update_changed = False
 
     mapping = {
         'wines': [TypeInserter(), WineryInserter(), CountryInserter(), RegionInserter(), StyleInserter(),
@@ -96,7 +478,10 @@ if __name__ == '__main__':
         # backup_dir = backup_dir + 'reviews/'  # todo maybe delete
         inserters.extend(mapping['reviews'])
 
-    read_files_insert_to_sql(backup_dir, inserters, clean_first, verbose)
+    read_files_insert_to_sql(backup_dir, inserters, clean_first, verbose, load_mode=load_mode, workers=workers,
+                             extract_workers=extract_workers, writers=writers,
+                             state_path=os.path.join(backup_dir, LOAD_STATE) if delta else None,
+                             update_changed=update_changed)
 
 
     # todo delete
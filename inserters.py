@@ -1,33 +1,63 @@
 from abc import ABC
-from typing import List, Dict
+from typing import List, Dict, Callable, Iterator
+from itertools import islice
+import os
+import tempfile
+import threading
 import time
-from ratelimiter import RateLimiter
+from storage import get_value
 
 
-class Inserter(ABC):
+class LoadError(Exception):
+    """
+    Raised when LOAD DATA dropped or changed rows for another reason than an existing primary key
+    """
+
 
-    def __init__(self, table: str, prefix="", paths=[], pk_sql=[], batch_size=60000):
+class Inserter(ABC):
+    # 'insert' runs INSERT ... ON DUPLICATE KEY UPDATE via executemany, 'bulk' streams rows to LOAD DATA LOCAL INFILE,
+    # 'staging' bulk loads all batches to a temporary table and merges it into the table with a single statement
+    LOAD_MODES = ['insert', 'bulk', 'staging']
+    # tables to be loaded before this one in addition to those referenced by foreign keys in schema.sql
+    DEPENDS_ON = []
+    # attributes which cannot be pickled: they are created again when an inserter is unpickled in another process
+    _RUNTIME_ATTRIBUTES = ['_extract_row', '_get_list', '_get_id_outside_list', '_lock']
+    DUPLICATE_KEY_WARNING = 1062  # code of the warning LOAD DATA ... IGNORE leaves for a skipped existing primary key
+    MAX_ERROR_COUNT = 65535  # largest number of warnings the server can keep for a statement
+
+    def __init__(self, table: str, prefix="", paths=[], pk_sql=[], batch_size=60000, load_mode='insert'):
+        if load_mode not in Inserter.LOAD_MODES:
+            raise ValueError(f"Unknown load mode {load_mode}, expected one of {Inserter.LOAD_MODES}")
         self.table = table
         self.prefix = prefix
         self.paths = [prefix + path for path in paths]
         self.pk_sql = pk_sql
         self.batch_size = batch_size
+        self.load_mode = load_mode
+        self.rows_loaded = 0  # rows given to the database, see _count_loaded_rows
+        self.rows_new = 0  # rows the database inserted
+        self._init_runtime_attributes()
+
+    def _init_runtime_attributes(self) -> None:
+        """
+        Function that compiles the paths of the inserter into extractor functions (see _compile_extractor)
+        """
+        self._extract_row = Inserter._compile_row_extractor(self.paths)
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict:
+        return {key: value for key, value in self.__dict__.items() if key not in Inserter._RUNTIME_ATTRIBUTES}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._init_runtime_attributes()
 
     @staticmethod
     def _get_value(match_entry: Dict, path0: str) -> any:
         """
         Function that returns a value found at a given path inside a given JSON record
         """
-        if path0 is None:
-            current_el = match_entry
-        else:
-            path = path0.split('/')
-            current_el = match_entry
-            for p in path:
-                if current_el is None:
-                    break
-                current_el = current_el.get(p)
-        return current_el
+        return match_entry if path0 is None else get_value(match_entry, path0)
 
     @staticmethod
     def _format_numbers(smth: any) -> any:
@@ -41,19 +71,77 @@ class Inserter(ABC):
         else:
             return smth
 
+    @staticmethod
+    def _compile_path(path0: str) -> Callable[[Dict], any]:
+        """
+        Function that turns a path into a function returning the value found at this path inside a JSON record
+        (same as _get_value), so that the path is split only once
+        """
+        if path0 is None:
+            return lambda match_entry: match_entry
+        return Inserter._compile_extractor([path0], format_numbers=False, as_tuple=False)
+
+    @staticmethod
+    def _compile_row_extractor(paths: List[str]) -> Callable[[Dict], tuple]:
+        """
+        Function that compiles a list of paths into a single function returning the tuple of formatted values found at
+        these paths inside a JSON record, as _get_value and _format_numbers would for each path one by one
+        """
+        return Inserter._compile_extractor(paths, format_numbers=True, as_tuple=True)
+
+    @staticmethod
+    def _compile_extractor(paths: List[str], format_numbers: bool, as_tuple: bool) -> Callable:
+        """
+        Function that generates the source of an extractor walking every common prefix of the paths only once, eg.
+        'vintage/wine' is looked up once for both 'vintage/wine/id' and 'vintage/wine/name', and compiles it
+        """
+        lines = ['def extract(match_entry):']
+        variables = {(): 'match_entry'}
+        values = []
+        for path in paths:
+            keys = tuple(path.split('/'))
+            for depth in range(1, len(keys) + 1):
+                if keys[:depth] not in variables:
+                    parent = variables[keys[:depth - 1]]
+                    variables[keys[:depth]] = f'v{len(variables)}'
+                    lines.append(f'    {variables[keys[:depth]]} = None if {parent} is None '
+                                 f'else {parent}.get({keys[depth - 1]!r})')
+            values.append(f'format_numbers({variables[keys]})' if format_numbers else variables[keys])
+        if as_tuple:
+            lines.append(f'    return ({"".join(value + ", " for value in values)})')
+        else:
+            lines.append(f'    return {values[0]}')
+        namespace = {'format_numbers': Inserter._format_numbers}
+        exec('\n'.join(lines), namespace)
+        return namespace['extract']
+
+    def _add_row(self, entry: Dict, all_args: Dict) -> None:
+        """
+        Function that extracts the row of a single batch entry and adds it to all_args (keyed by primary key),
+        unless the primary key is missing
+        """
+        values_entry = self._extract_row(entry)
+        pk_values = values_entry[:len(self.pk_sql)]  # provided primary keys always come first
+        #  We'd like to eliminate duplicates from our batch, as well as records with Null primary keys.
+        if None not in pk_values:
+            all_args[pk_values] = values_entry
+
+    def _add_rows(self, match_entry: Dict, all_args: Dict) -> None:
+        """
+        Function that adds all rows a single raw JSON record contributes to the table (used by MultiTableExtractor)
+        """
+        self._add_row(match_entry, all_args)
+
     def _extract_args(self, matches_list: List[Dict]) -> List[tuple]:
         """
         Function that converts raw JSON data to a list of tuple with specific fields necessary for a given inserter,
         no duplicates and no missing primary keys
         """
         all_args = {}
+        add_row = self._add_row
         for entry in matches_list:
             # here, each entry represents a Python dictionary
-            values_entry = [Inserter._format_numbers(Inserter._get_value(entry, path)) for path in self.paths]
-            pk_values = values_entry[:len(self.pk_sql)]  # provided primary keys always come first
-            #  We'd like to eliminate duplicates from our batch, as well as records with Null primary keys.
-            if all(pk_value is not None for pk_value in pk_values):
-                all_args[tuple(pk_values)] = tuple(values_entry)
+            add_row(entry, all_args)
         return list(all_args.values())
 
     def _fields_num(self):
@@ -62,23 +150,56 @@ class Inserter(ABC):
         """
         return len(self.paths)
 
-    # @RateLimiter(1, 60)
     def _insert_json_to_sql(self, conn, matches: List[Dict], verbose: bool) -> None:
         """
         Function inserts JSON data to SQL and (if it's the first entry) checks whether the resulting number of unique
         records in SQL matches the number of unique records in JSON.
         """
-        cur = conn.cursor()
         timepoint_1 = time.time()
         args = self._extract_args(matches)
+        self._insert_args_to_sql(conn, args, verbose, timepoint_1)
+
+    def _insert_args_to_sql(self, conn, args: List[tuple], verbose: bool, timepoint_1=None) -> None:
+        """
+        Function inserts rows already extracted from JSON to SQL and counts how many of them were new to the table,
+        as reported by the database (see _count_loaded_rows)
+        """
+        cur = conn.cursor()
+        if timepoint_1 is None:
+            timepoint_1 = time.time()
+
+        timepoint_2 = time.time()
+        print(f'Up until execution the current iteration took {round(timepoint_2 - timepoint_1, 2)} s.')
+        if self.load_mode == 'bulk':
+            rows_new = self._load_args_to_sql(cur, args)
+        else:
+            rows_new = self._execute_insert(cur, args)
+        timepoint_3 = time.time()
+        print(f'Program took {round(timepoint_3 - timepoint_2, 2)} s. to execute')
+        conn.commit()
+        timepoint_4 = time.time()
+        print(f'Program took {round(timepoint_4 - timepoint_3, 2)} s. to commit changes')
+        self._count_loaded_rows(len(args), rows_new)
 
         if verbose:
-            # find the number of records before insertion
-            cur2 = conn.cursor()
-            cur2.execute('SELECT COUNT(*) FROM {}'.format(self.table))
-            records_sql_before = cur2.fetchall()[0][0]  # counts unique entries in the table before the insert statement
-            cur2.close()
+            print(f'Insertion to {self.table} complete and took {round(time.time() - timepoint_1, 2)} s., '
+                  f'{rows_new} of {len(args)} rows were new')
 
+    def _count_loaded_rows(self, rows_loaded: int, rows_new: int) -> None:
+        """
+        Function that adds up the rows given to the database and the rows it actually inserted (its affected rows:
+        rows skipped as duplicates of existing primary keys are not counted), so that loading can be verified once per
+        run instead of counting all records of the table after every batch
+        """
+        with self._lock:  # the same table can be loaded from several files at once
+            self.rows_loaded += rows_loaded
+            self.rows_new += rows_new
+
+    def _execute_insert(self, cur, args: List[tuple], table=None) -> int:
+        """
+        Function that inserts rows with a prepared INSERT statement, ignoring rows whose primary key already exists,
+        and returns the number of inserted rows
+        """
         # part of the query that tells to do nothing on duplicate keys if such entry already exists,
         # depending on the number of primary keys
         if len(self.pk_sql) == 0:
@@ -88,36 +209,137 @@ class Inserter(ABC):
                                        ', '.join([f'{key} = {key}' for key in self.pk_sql])
 
         query = f"""
-                INSERT INTO {self.table} VALUES ({', '.join('?' * self._fields_num())})
+                INSERT INTO {table or self.table} VALUES ({', '.join('?' * self._fields_num())})
                 {if_duplicates_do_nothing}
             """.strip()
-        timepoint_2 = time.time()
-        print(f'Up until execution the current iteration took {round(timepoint_2 - timepoint_1, 2)} s.')
         cur.executemany(query, args)
-        timepoint_3 = time.time()
-        print(f'Program took {round(timepoint_3 - timepoint_2, 2)} s. to execute')
-        conn.commit()
-        timepoint_4 = time.time()
-        print(f'Program took {round(timepoint_4 - timepoint_3, 2)} s. to commit changes')
+        return cur.rowcount  # 'key = key' leaves existing rows unchanged, and unchanged rows are not affected
 
+    @staticmethod
+    def _format_tsv_field(value: any) -> str:
+        """
+        Function that formats a single value the way LOAD DATA reads it by default: NULL as \\N, booleans as 1/0,
+        whole floats without the fraction, and backslashes, tabs and line breaks escaped
+        """
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, float):
+            return str(int(value)) if value.is_integer() else repr(value)
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def _write_tsv(self, f, args: List[tuple]) -> None:
+        """
+        Function that writes rows to a file as tab-separated values, one row per line
+        """
+        format_field = Inserter._format_tsv_field
+        for row in args:
+            f.write('\t'.join([format_field(value) for value in row]))
+            f.write('\n')
+
+    def _load_args_to_sql(self, cur, args: List[tuple], table=None) -> int:
+        """
+        Function that loads rows with LOAD DATA LOCAL INFILE through a temporary TSV file and returns the number of
+        inserted rows. IGNORE skips rows whose primary key already exists, as ON DUPLICATE KEY UPDATE does for
+        inserts; any other row it drops or changes raises LoadError (see _check_load_warnings). The connection has to
+        be opened with local_infile enabled.
+        """
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.tsv', delete=False) as f:
+            self._write_tsv(f, args)
+        try:
+            path = f.name.replace('\\', '/')
+            # keeps a warning for every row of the batch, so that none of them goes unchecked
+            cur.execute(f"SET SESSION max_error_count = {Inserter.MAX_ERROR_COUNT}")
+            cur.execute(f"LOAD DATA LOCAL INFILE '{path}' IGNORE INTO TABLE {table or self.table} CHARACTER SET utf8mb4 "
+                        f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'")
+            rows_new = cur.rowcount
+            self._check_load_warnings(cur, table or self.table)
+            return rows_new
+        finally:
+            os.remove(f.name)
+
+    @staticmethod
+    def _check_load_warnings(cur, table: str) -> None:
+        """
+        Function that raises LoadError if the last LOAD DATA ... IGNORE left warnings other than skipped duplicate
+        keys: IGNORE also turns foreign key violations and values which had to be converted or truncated into
+        warnings, and drops or changes those rows, where INSERT would fail
+        """
+        cur.execute("SHOW COUNT(*) WARNINGS")
+        warnings_num = cur.fetchone()[0]
+        if warnings_num == 0:
+            return
+        cur.execute("SHOW WARNINGS")
+        warnings = cur.fetchall()  # (level, code, message) tuples
+        problems = [warning for warning in warnings if int(warning[1]) != Inserter.DUPLICATE_KEY_WARNING]
+        if len(problems) > 0:
+            raise LoadError(f"Loading {table} left {len(problems)} warnings other than duplicate keys, eg. "
+                            f"{problems[0][2]}")
+        if len(warnings) < warnings_num:
+            raise LoadError(f"Loading {table} left {warnings_num} warnings, only {len(warnings)} of them could be "
+                            f"checked; use batches of at most {Inserter.MAX_ERROR_COUNT} rows")
+
+    def _staging_table(self) -> str:
+        return f"{self.table}_staging"
+
+    def _merge_query(self) -> str:
+        """
+        Function that returns the statement copying the rows of the staging table whose primary key is not in the table
+        yet (an anti-join, so existing rows are not updated). Run at READ COMMITTED, InnoDB reads the table as a
+        consistent read and does not lock its existing rows; at REPEATABLE READ the rows scanned get shared locks
+        """
+        staging = self._staging_table()
+        if len(self.pk_sql) == 0:
+            return f"INSERT INTO {self.table} SELECT * FROM {staging}"
+        join_on = ' AND '.join([f's.{key} = t.{key}' for key in self.pk_sql])
+        return f"INSERT INTO {self.table} SELECT s.* FROM {staging} s LEFT JOIN {self.table} t ON {join_on} " \
+               f"WHERE t.{self.pk_sql[0]} IS NULL"
+
+    def _insert_via_staging(self, conn, batches: Iterator[List[tuple]], verbose: bool) -> None:
+        """
+        Function that loads batches of rows to a temporary staging table, then merges them into the table in one
+        set-based statement and one READ COMMITTED transaction, so that only the rows inserted are locked, and only for
+        the duration of the merge.
+        The staging table lives only as long as the connection, so concurrent loads do not see each other's rows.
+        :param conn: active connection to x
+        :param batches: batches of deduplicated rows of the table
+        :param verbose: boolean if asked to print the progress of loading
+        :return: None
+        """
+        timepoint_1 = time.time()
+        staging = self._staging_table()
+        cur = conn.cursor()
+        cur.execute(f"DROP TEMPORARY TABLE IF EXISTS {staging}")
+        cur.execute(f"CREATE TEMPORARY TABLE {staging} LIKE {self.table}")
+        try:
+            rows_staged = 0
+            for args in batches:
+                # IGNORE also drops rows repeated across batches, as the staging table has the same primary key
+                self._load_args_to_sql(cur, args, table=staging)
+                rows_staged += len(args)
+            conn.commit()
+            timepoint_2 = time.time()
+            print(f'Staging {rows_staged} rows for {self.table} took {round(timepoint_2 - timepoint_1, 2)} s.')
+            # applies to the next transaction only, so the connection goes back to its own isolation level after
+            cur.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+            cur.execute(self._merge_query())
+            rows_merged = cur.rowcount
+            conn.commit()
+            print(f'Program took {round(time.time() - timepoint_2, 2)} s. to merge {rows_merged} new rows to '
+                  f'{self.table}')
+            self._count_loaded_rows(rows_staged, rows_merged)
+        finally:
+            cur.execute(f"DROP TEMPORARY TABLE IF EXISTS {staging}")
         if verbose:
             print(f'Insertion to {self.table} complete and took {round(time.time() - timepoint_1, 2)} s.')
 
-            cur3 = conn.cursor()
-            cur3.execute('SELECT COUNT(*) FROM {}'.format(self.table))
-            records_sql_after = cur3.fetchall()[0][0]  # counts unique entries in the table after the insert statement
-            args_python = len(args)  # counts unique entries in JSON
-            if args_python == (records_sql_after - records_sql_before):
-                print(f'Number of unique records in table {self.table} is accurate and equals {records_sql_after} '
-                      f'after insert')
-            else:
-                print(f'The table {self.table} increased by {(records_sql_after - records_sql_before)} records')
-
-    def _get_batch(self, i: int, matches: List[Dict]) -> List[Dict]:
+    def _iter_batches(self, matches: List[Dict]) -> Iterator[List[Dict]]:
         """
-        Function that returns a batch to be inserted to SQL (controls the weight)
+        Generator that cuts JSON data into batches to be inserted to SQL (controls the weight)
         """
-        return matches[i:(i + self.batch_size)]
+        for i in range(0, len(matches), self.batch_size):
+            yield matches[i:(i + self.batch_size)]
 
     def insert(self, conn, matches: List[Dict], verbose: bool) -> None:
         """
@@ -127,10 +349,54 @@ class Inserter(ABC):
         :param verbose: boolean if asked to print the progress of loading
         :return: None
         """
-        for i in range(0, len(matches), self.batch_size):
-            batch = self._get_batch(i, matches)
+        if self.load_mode == 'staging':
+            self._insert_via_staging(conn, (self._extract_args(batch) for batch in self._iter_batches(matches)),
+                                     verbose)
+            return
+        for batch in self._iter_batches(matches):
             self._insert_json_to_sql(conn, batch, verbose)
 
+    def insert_rows(self, conn, args: List[tuple], verbose: bool) -> None:
+        """
+        Function that inserts rows already extracted from JSON (eg. by MultiTableExtractor) into SQL in batches
+        :param conn: active connection to x
+        :param args: deduplicated rows of the table
+        :param verbose: boolean if asked to print the progress of loading
+        :return: None
+        """
+        if self.load_mode == 'staging':
+            self._insert_via_staging(conn, (args[i:(i + self.batch_size)]
+                                            for i in range(0, len(args), self.batch_size)), verbose)
+            return
+        for i in range(0, len(args), self.batch_size):
+            self._insert_args_to_sql(conn, args[i:(i + self.batch_size)], verbose)
+
+    def update_rows(self, conn, args: List[tuple], verbose: bool) -> None:
+        """
+        Function that overwrites the records of the table having the primary keys of given rows with the values of
+        these rows (eg. changed ratings counts or prices), inserting those which do not exist yet
+        :param conn: active connection to x
+        :param args: deduplicated rows of the table
+        :param verbose: boolean if asked to print the progress of loading
+        :return: None
+        """
+        if not args:
+            return
+        cur = conn.cursor()
+        cur.execute(f"SELECT * FROM {self.table} LIMIT 0")
+        columns = [column[0] for column in cur.description]  # in the same order as the fields of the rows
+        updates = [f'{column} = VALUES({column})' for column in columns if column not in self.pk_sql]
+        if not updates:
+            return  # rows holding only a primary key cannot change
+        query = f"INSERT INTO {self.table} VALUES ({', '.join('?' * self._fields_num())}) " \
+                f"ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+        timepoint_1 = time.time()
+        for i in range(0, len(args), self.batch_size):
+            cur.executemany(query, args[i:(i + self.batch_size)])
+            conn.commit()
+        if verbose:
+            print(f'Updating {len(args)} changed rows of {self.table} took {round(time.time() - timepoint_1, 2)} s.')
+
     def clean_table(self, conn) -> None:
         """
         Function that deletes all records from a given table in a given database
@@ -139,6 +405,18 @@ class Inserter(ABC):
         cur.execute(f'DELETE FROM {self.table}')
         conn.commit()
 
+    def report_loaded_rows(self) -> None:
+        """
+        Function that prints how many of the rows loaded during the run were new to the table and how many were
+        already there
+        """
+        rows_existing = self.rows_loaded - self.rows_new
+        if rows_existing == 0:
+            print(f'All {self.rows_loaded} rows loaded to {self.table} are new records of the table')
+        else:
+            print(f'{self.rows_new} of {self.rows_loaded} rows loaded to {self.table} are new records of the table, '
+                  f'{rows_existing} were there already')
+
     def count_records(self, conn, when='After insert') -> None:
         """
         Function that checks the number of unique records in a given table
@@ -150,51 +428,71 @@ class Inserter(ABC):
 
 class FromListInserter(Inserter):
 
-    def __init__(self, table, path_to_list, paths_from_list=[], pk_sql=[], batch_size=60000):
-        super().__init__(table, '', paths_from_list, pk_sql, batch_size)
+    def __init__(self, table, path_to_list, paths_from_list=[], pk_sql=[], batch_size=60000, load_mode='insert'):
         if not path_to_list:
             raise ValueError
         self.path_to_list = path_to_list
+        super().__init__(table, '', paths_from_list, pk_sql, batch_size, load_mode)
+
+    def _init_runtime_attributes(self) -> None:
+        super()._init_runtime_attributes()
+        self._get_list = Inserter._compile_path(self.path_to_list)
 
     def _get_list_element_with_id(self, element: any, entry: Dict) -> any:
         return element
 
-    def _get_batch(self, i: int, matches: List[Dict]) -> List[Dict]:
-        results = []
+    def _add_rows(self, match_entry: Dict, all_args: Dict) -> None:
+        elements = self._get_list(match_entry)
+        if elements is not None:
+            for element in elements:
+                self._add_row(self._get_list_element_with_id(element, match_entry), all_args)
+
+    def _iter_elements(self, matches: List[Dict]) -> Iterator[any]:
+        """
+        Generator that yields the list elements of all records one by one, without building a flattened list
+        """
         for entry in matches: # here, entry is a dictionary that contains required values
-            if Inserter._get_value(entry, self.path_to_list) is not None:
-                for element in Inserter._get_value(entry, self.path_to_list):
-                    results.append(self._get_list_element_with_id(element, entry))
-        return results
+            elements = self._get_list(entry)
+            if elements is not None:
+                for element in elements:
+                    yield self._get_list_element_with_id(element, entry)
+
+    def _iter_batches(self, matches: List[Dict]) -> Iterator[List[any]]:
+        # batches are cut from the list elements rather than from the records, one batch at a time
+        elements = self._iter_elements(matches)
+        batch = list(islice(elements, self.batch_size))
+        while batch:
+            yield batch
+            batch = list(islice(elements, self.batch_size))
 
 
 class FromListWithExternalIdInserter(FromListInserter):
 
-    def __init__(self, table, path_to_list, path_to_id_outside_list, paths_from_list=[], pk_sql=[], batch_size=60000):
-        super().__init__(table, path_to_list, paths_from_list, pk_sql, batch_size)
+    def __init__(self, table, path_to_list, path_to_id_outside_list, paths_from_list=[], pk_sql=[], batch_size=60000,
+                 load_mode='insert'):
         if not path_to_id_outside_list:
             raise ValueError
         self.path_to_id_outside_list = path_to_id_outside_list
+        super().__init__(table, path_to_list, paths_from_list, pk_sql, batch_size, load_mode)
+
+    def _init_runtime_attributes(self) -> None:
+        super()._init_runtime_attributes()
+        self._get_id_outside_list = Inserter._compile_path(self.path_to_id_outside_list)
 
     def _get_list_element_with_id(self, element: any, entry: Dict): #TODO type annot
-        return Inserter._get_value(entry, self.path_to_id_outside_list), element
+        return self._get_id_outside_list(entry), element
 
-    def _extract_args(self, matches_list: List) -> List[tuple]: #TODO type annot
-        all_args = {}
-        for entry in matches_list:
-            # here, each entry represents a tuple with two elements:
-            # id and a JSON element for extraction of necessary paths
-            if len(self.paths) == 0:
-                # for record in entry[1]:
-                all_args[entry] = entry
-            else:
-                values_entry = [entry[0]] + \
-                               [Inserter._format_numbers(Inserter._get_value(entry[1], path)) for path in self.paths]
-                pk_values = values_entry[:len(self.pk_sql)]  # provided primary keys always come first
-                #  We'd like to eliminate duplicates from our batch, as well as records with Null primary keys.
-                if all(pk_value is not None for pk_value in pk_values):
-                    all_args[tuple(pk_values)] = tuple(values_entry)
-        return list(all_args.values())
+    def _add_row(self, entry: tuple, all_args: Dict) -> None:
+        # here, each entry represents a tuple with two elements:
+        # id and a JSON element for extraction of necessary paths
+        if len(self.paths) == 0:
+            all_args[entry] = entry
+        else:
+            values_entry = (entry[0],) + self._extract_row(entry[1])
+            pk_values = values_entry[:len(self.pk_sql)]  # provided primary keys always come first
+            #  We'd like to eliminate duplicates from our batch, as well as records with Null primary keys.
+            if None not in pk_values:
+                all_args[pk_values] = values_entry
 
     def _fields_num(self):
         return len(self.paths) + 1
@@ -206,11 +504,18 @@ class TypeInserter(Inserter):
     def __init__(self):
         super().__init__(TypeInserter.TABLE)
 
+    def _add_rows(self, match_entry: Dict, all_args: Dict) -> None:
+        pass  # types do not come from JSON, see insert
+
+    def insert_rows(self, conn, args=None, verbose=True):
+        self.insert(conn, verbose=verbose)
+
     def insert(self, conn, matches=None, verbose=True):
         cur = conn.cursor()
         cur.execute(
             f"INSERT INTO {self.table} VALUES (1, 'Red'), (2, 'White'), (3, 'Sparkling'), (4, 'Rose'), (7, 'Dessert'), "
             f"(24, 'Fortified'), (25, 'Other') ON DUPLICATE KEY UPDATE id = id")
+        self._count_loaded_rows(7, cur.rowcount)
         conn.commit()
 
 
@@ -459,23 +764,59 @@ class ReviewInserter(Inserter):
     TABLE = 'review'
     PATHS = ['id', 'rating', 'note', 'language', 'created_at', 'aggregated', 'user/id', 'activity/id', 'tagged_note']
     PK_SQL = ['id']
+    LOAD_MODE = 'insert'  # 'bulk' is faster, but needs local_infile enabled on the server
 
-    def __init__(self):
+    def __init__(self, load_mode=LOAD_MODE):
         super().__init__(ReviewInserter.TABLE,
                          paths=ReviewInserter.PATHS,
                          pk_sql=ReviewInserter.PK_SQL,
-                         batch_size=6000)
+                         # LOAD DATA streams the file, so only executemany needs small batches of long notes
+                         batch_size=6000 if load_mode == 'insert' else 60000,
+                         load_mode=load_mode)
 
 
 class VintageReviewInserter(Inserter):
     TABLE = 'vintage_review'
     PATHS = ['vintage/id', 'id']
     PK_SQL = ['vintage_id', 'review_id']
+    LOAD_MODE = 'insert'  # see ReviewInserter
 
-    def __init__(self):
+    def __init__(self, load_mode=LOAD_MODE):
         super().__init__(VintageReviewInserter.TABLE,
                          paths=VintageReviewInserter.PATHS,
-                         pk_sql=VintageReviewInserter.PK_SQL)
+                         pk_sql=VintageReviewInserter.PK_SQL,
+                         load_mode=load_mode)
 
 
+class MultiTableExtractor:
+    """
+    Walks every raw JSON record exactly once and extracts rows for all given inserters at the same time, instead of
+    letting each inserter walk the whole list on its own. Paths and primary keys still come from the inserters.
+    """
 
+    def __init__(self, inserters: List[Inserter]):
+        self.inserters = inserters
+
+    def extract(self, matches: List[Dict]) -> Dict[str, List[tuple]]:
+        """
+        Function that returns deduplicated rows for every table, the same as each inserter would extract on its own
+        :param matches: original JSON
+        :return: dictionary mapping table names to lists of rows
+        """
+        all_args = {inserter.table: {} for inserter in self.inserters}
+        # rows of inserters taking one row per record are extracted inline, the others add their rows on their own
+        plain, others = [], []
+        for inserter in self.inserters:
+            if type(inserter)._add_rows is Inserter._add_rows and type(inserter)._add_row is Inserter._add_row:
+                plain.append((inserter._extract_row, len(inserter.pk_sql), all_args[inserter.table]))
+            else:
+                others.append((inserter._add_rows, all_args[inserter.table]))
+        for match_entry in matches:
+            for extract_row, pk_len, table_args in plain:
+                values_entry = extract_row(match_entry)
+                pk_values = values_entry[:pk_len]
+                if None not in pk_values:
+                    table_args[pk_values] = values_entry
+            for add_rows, table_args in others:
+                add_rows(match_entry, table_args)
+        return {table: list(table_args.values()) for table, table_args in all_args.items()}
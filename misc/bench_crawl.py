@@ -0,0 +1,69 @@
+"""
+End-to-end benchmark of Crawler against the local mock of the Vivino API (see mock_vivino.py): crawls the whole
+catalogue with download_all_wines, then the reviews of the crawled wines with download_reviews and
+download_reviews_async, and reports requests per second, wall time and peak memory of every stage.
+Usage: python misc/bench_crawl.py [--wines N] [--latency S] [--rate R] [--error-rate P] [--throttle-rate P]
+                                  [--concurrency C] [--reviewed-wines N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from crawlers import Crawler
+from crawl import wines_as_df
+from mock_vivino import MockVivino
+
+
+def run_stage(name: str, server: MockVivino, stage) -> any:
+    """
+    Function that runs a stage of the crawl and prints its number of requests, wall time and peak memory
+    """
+    requests_before = sum(server.requests.values())
+    tracemalloc.start()
+    timepoint_0 = time.perf_counter()
+    result = stage()
+    wall_time = time.perf_counter() - timepoint_0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    requests_num = sum(server.requests.values()) - requests_before
+    print(f"{name:>24}: {requests_num:>6} requests in {round(wall_time, 2):>7} s. "
+          f"({round(requests_num / wall_time, 1):>7} requests/s), peak memory {round(peak / 1024 ** 2, 1)} Mb")
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the crawler against a local mock of the Vivino API')
+    parser.add_argument("--wines", type=int, default=5000, help="number of vintages in the catalogue")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every response")
+    parser.add_argument("--rate", type=float, default=None, help="requests per second allowed by the server")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 5xx")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests failing with 429")
+    parser.add_argument("--client-rate", type=float, default=1000, help="requests per second allowed by the crawler")
+    parser.add_argument("--concurrency", type=int, default=8, help="wines downloaded concurrently by the async crawl")
+    parser.add_argument("--reviewed-wines", type=int, default=300, help="number of wines to download reviews for")
+    args = parser.parse_args()
+
+    Crawler.BACKOFF_BASE = 0.05  # injected errors are retried quickly, the real API needs the default
+    with MockVivino(wines_num=args.wines, latency=args.latency, rate=args.rate, error_rate=args.error_rate,
+                    throttle_rate=args.throttle_rate) as server, tempfile.TemporaryDirectory() as backup_dir:
+        limits = {'explore': (args.client_rate, 1), 'reviews': (args.client_rate, args.concurrency)}
+        crawler = Crawler(backup_dir + '/', verbose=False, rate_limits=limits)
+        server.point(crawler)
+
+        wines = run_stage('download_all_wines', server, lambda: crawler.download_all_wines(
+            0, 400, with_prices=False, inter_backup=False, final_backup=True))
+        assert len({match['vintage']['id'] for match in wines}) == args.wines, "Some vintages were not crawled"
+
+        wines_df = wines_as_df(wines).head(args.reviewed_wines)
+        reviews = run_stage('download_reviews', server, lambda: crawler.download_reviews(wines_df, 'All', 'all'))
+        reviews_async = run_stage(f'download_reviews_async({args.concurrency})', server, lambda: asyncio.run(
+            crawler.download_reviews_async(wines_df, 'All', 'all', args.concurrency)))
+        assert reviews == reviews_async, "Asynchronous crawl returned different reviews"
+
+        print(f"{len(wines)} vintages and {len(reviews)} reviews crawled, server responses by status: "
+              f"{dict(sorted(server.responses.items()))}")
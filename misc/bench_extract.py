@@ -0,0 +1,102 @@
+"""
+Microbenchmark of Inserter._extract_args: compiled row extractors against walking every path with _get_value,
+and of MultiTableExtractor against every inserter walking the records on its own.
+Usage: python misc/bench_extract.py [number of records]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from inserters import *
+
+
+def extract_args_by_path(inserter, matches_list):
+    """
+    Extraction as it was done before paths were compiled: each path is split and walked for every record
+    """
+    all_args = {}
+    for entry in matches_list:
+        values_entry = [Inserter._format_numbers(Inserter._get_value(entry, path)) for path in inserter.paths]
+        pk_values = values_entry[:len(inserter.pk_sql)]
+        if all(pk_value is not None for pk_value in pk_values):
+            all_args[tuple(pk_values)] = tuple(values_entry)
+    return list(all_args.values())
+
+
+def make_match(i):
+    country = {'code': 'fr', 'name': 'France', 'native_name': 'France', 'seo_name': 'france',
+               'currency': {'code': 'EUR'}, 'regions_count': 1000, 'users_count': 5000, 'wines_count': 90000,
+               'wineries_count': 20000}
+    return {
+        'vintage': {
+            'id': i, 'seo_name': f'wine-{i}', 'name': f'Wine {i}', 'year': random.choice([2015, 2016, 'N.V.']),
+            'has_valid_ratings': True,
+            'top_list_rankings': [{'top_list': {'id': i % 10, 'location': 'GB', 'name': 'Top', 'seo_name': 'top',
+                                                'type': 1, 'year': 2020}, 'rank': 1, 'previous_rank': 2,
+                                   'description': 'Top 10'}],
+            'statistics': {'status': 'Normal', 'ratings_count': random.randint(0, 5000),
+                           'ratings_average': 3.8, 'labels_count': 100},
+            'wine': {
+                'id': i // 3, 'name': f'Wine {i // 3}', 'seo_name': f'wine-{i // 3}', 'type_id': 1,
+                'vintage_type': 0, 'is_natural': False,
+                'region': {'id': i % 500, 'name': 'Bordeaux', 'name_en': '', 'seo_name': 'bordeaux',
+                           'country': country},
+                'winery': {'id': i % 2000, 'name': 'Chateau', 'seo_name': 'chateau', 'status': 0},
+                'taste': {'structure': {'acidity': 3.1, 'fizziness': None, 'intensity': 3.7, 'sweetness': 1.8,
+                                        'tannin': 2.9, 'user_structure_count': 54,
+                                        'calculated_structure_count': 18}},
+                'style': {'food': [{'id': i % 40, 'name': 'Beef', 'seo_name': 'beef'}],
+                          'grapes': [{'id': i % 60, 'name': 'Merlot', 'seo_name': 'merlot',
+                                      'has_detailed_info': True, 'wines_count': 1000}],
+                          'interesting_facts': [f'Fact {i % 300}'],
+                          'id': i % 300, 'seo_name': 'bordeaux-red', 'regional_name': 'Bordeaux',
+                          'varietal_name': None, 'name': 'Bordeaux Red', 'description': 'Long text ' * 20,
+                          'blurb': None, 'body': 4, 'body_description': 'Full-bodied', 'acidity': 3,
+                          'acidity_description': 'High', 'country': country, 'wine_type_id': 1},
+                'statistics': {'status': 'Normal', 'ratings_count': 10000, 'ratings_average': 3.9,
+                               'labels_count': 50000, 'vintages_count': 30},
+                'has_valid_ratings': True,
+            },
+        },
+        'price': {'id': 10 ** 6 + i, 'amount': 12.5, 'discounted_from': None, 'type': 'vc', 'visibility': 1,
+                  'currency': {'code': 'GBP'}, 'bottle_type': {'name': 'Bottle (0.75l)'}},
+    }
+
+
+if __name__ == '__main__':
+    records_num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(0)
+    matches = [make_match(i) for i in range(records_num)]
+    inserters = [WineryInserter(), CountryInserter(), RegionInserter(), StyleInserter(), WineInserter(),
+                 PriceInserter(), VintageInserter()]
+
+    total_before = total_after = 0
+    for inserter in inserters:
+        timepoint_0 = time.perf_counter()
+        before = extract_args_by_path(inserter, matches)
+        timepoint_1 = time.perf_counter()
+        after = inserter._extract_args(matches)
+        timepoint_2 = time.perf_counter()
+        assert before == after, f"Rows extracted for {inserter.table} differ"
+        total_before += timepoint_1 - timepoint_0
+        total_after += timepoint_2 - timepoint_1
+        print(f"{inserter.table:>8}: {round(records_num / (timepoint_1 - timepoint_0)):>9} records/s before, "
+              f"{round(records_num / (timepoint_2 - timepoint_1)):>9} records/s after")
+    print(f"   total: {round(total_before, 2)} s. before, {round(total_after, 2)} s. after "
+          f"({round(total_before / total_after, 1)}x faster)")
+
+    inserters = [WineryInserter(), CountryInserter(), RegionInserter(), StyleInserter(), FoodInserter(),
+                 FactInserter(), StyleFoodInserter(), GrapeInserter(), StyleGrapeInserter(), CountryGrapeInserter(),
+                 WineInserter(), PriceInserter(), VintageInserter(), ToplistInserter(), VintageToplistInserter()]
+    timepoint_0 = time.perf_counter()
+    separately = {inserter.table: inserter._extract_args(list(inserter._iter_elements(matches))
+                                                         if isinstance(inserter, FromListInserter) else matches)
+                  for inserter in inserters}
+    timepoint_1 = time.perf_counter()
+    together = MultiTableExtractor(inserters).extract(matches)
+    timepoint_2 = time.perf_counter()
+    assert separately == together, "Rows extracted by MultiTableExtractor differ"
+    print(f"{len(inserters)} wine inserters: {round(timepoint_1 - timepoint_0, 2)} s. one by one, "
+          f"{round(timepoint_2 - timepoint_1, 2)} s. in a single pass")
@@ -0,0 +1,216 @@
+"""
+Local stand-in for the Vivino API serving a synthetic catalogue, so that Crawler can be exercised offline.
+Serves /api/explore/explore (filtered by price_range_min/price_range_max, capped at page_cap pages) and
+/api/wines/{id}/latest_reviews (newest reviews first), with configurable latency, rate limits and injected errors.
+Usage: python misc/mock_vivino.py [--port PORT] [--wines N] [--latency S] [--rate R] [--error-rate P] [--throttle-rate P]
+"""
+from typing import List, Dict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+COUNTRIES = ['France', 'Italy', 'Spain', 'Portugal', 'Germany']
+YEARS = [2015, 2016, 2017, 2018, 2019, 'N.V.']
+
+
+def make_catalogue(wines_num: int, seed=0, no_price_share=0.05) -> List[Dict]:
+    """
+    Function that generates explore matches for a given number of vintages, with deterministic prices, ratings counts
+    and countries; a share of vintages has no price
+    """
+    rand = random.Random(seed)
+    catalogue = []
+    for i in range(wines_num):
+        country = COUNTRIES[i % len(COUNTRIES)]
+        price = None if rand.random() < no_price_share else round(rand.uniform(1, 400), 2)
+        catalogue.append({
+            'vintage': {
+                'id': 1000000 + i, 'name': f'Wine {i}', 'seo_name': f'wine-{i}', 'year': rand.choice(YEARS),
+                'has_valid_ratings': True,
+                'statistics': {'status': 'Normal', 'ratings_count': rand.choice([0, 3, 20, 60, 150, 400]),
+                               'ratings_average': round(rand.uniform(3, 5), 1), 'labels_count': 100},
+                'wine': {'id': 500000 + i, 'name': f'Wine {i}', 'seo_name': f'wine-{i}', 'type_id': 1,
+                         'region': {'id': i % 300, 'name': f'Region {i % 300}',
+                                    'country': {'code': country[:2].lower(), 'name': country}},
+                         'winery': {'id': i % 1000, 'name': f'Winery {i % 1000}'}},
+            },
+            'price': None if price is None else {'id': 2000000 + i, 'amount': price, 'currency': {'code': 'GBP'}},
+        })
+    catalogue.sort(key=lambda match: -match['vintage']['statistics']['ratings_average'])
+    return catalogue
+
+
+def make_reviews(vintage: Dict, page: int, per_page: int) -> List[Dict]:
+    """
+    Function that returns a page of synthetic reviews of a vintage, from the newest to the oldest
+    """
+    reviews_num = vintage['statistics']['ratings_count']
+    reviews = []
+    for k in range((page - 1) * per_page, min(page * per_page, reviews_num)):
+        age = k * 3600  # one review per hour, going back in time
+        reviews.append({
+            'id': vintage['id'] * 1000 + k, 'rating': 4.0, 'note': f'Review {k}', 'language': 'en',
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(1600000000 - age)),
+            'aggregated': True, 'user': {'id': k % 5000, 'alias': f'User {k % 5000}'},
+            'activity': {'id': vintage['id'] * 1000 + k},
+            'vintage': {'id': vintage['id'], 'year': vintage['year'], 'wine': {'id': vintage['wine']['id']}},
+        })
+    return reviews
+
+
+class MockVivino(ThreadingHTTPServer):
+    """
+    HTTP server answering Crawler requests from a synthetic catalogue.
+    Every endpoint family (explore, reviews) allows `rate` requests per second and answers 429 with Retry-After beyond
+    that; on top of it, error_rate of the requests fail with a 5xx status and throttle_rate of them with a 429.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, wines_num=5000, latency=0.0, rate=None, error_rate=0.0, throttle_rate=0.0,
+                 page_cap=80, seed=0):
+        super().__init__(('127.0.0.1', port), MockVivinoHandler)
+        self.catalogue = make_catalogue(wines_num, seed)
+        self.vintages_by_wine = {match['vintage']['wine']['id']: match['vintage'] for match in self.catalogue}
+        self.latency = latency
+        self.rate = rate
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.page_cap = page_cap
+        self.random = random.Random(seed)
+        self.requests = {'explore': 0, 'reviews': 0}
+        self.responses = {}  # status -> count
+        self._next_allowed = {'explore': 0.0, 'reviews': 0.0}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def point(self, crawler) -> None:
+        """
+        Function that redirects the requests of a Crawler instance to this server
+        """
+        crawler.EXPLORE_PAGE_TEMPLATE = crawler.EXPLORE_PAGE_TEMPLATE.replace('https://www.vivino.com', self.base_url)
+        crawler.REVIEWS_PAGE_TEMPLATE = crawler.REVIEWS_PAGE_TEMPLATE.replace('https://www.vivino.com', self.base_url)
+
+    def start(self) -> 'MockVivino':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def admit(self, endpoint: str) -> tuple:
+        """
+        Function that counts a request and decides whether it fails
+        :return: (status, seconds to retry after) tuple; status 200 if the request is to be answered
+        """
+        with self._lock:
+            self.requests[endpoint] += 1
+            now = time.monotonic()
+            if self.rate is not None:
+                if now < self._next_allowed[endpoint]:
+                    return 429, self._next_allowed[endpoint] - now
+                self._next_allowed[endpoint] = now + 1 / self.rate
+            draw = self.random.random()
+        if draw < self.error_rate:
+            return self.random.choice([500, 502, 503]), None
+        if draw < self.error_rate + self.throttle_rate:
+            return 429, 1
+        return 200, None
+
+    def explore(self, query: Dict) -> Dict:
+        page = int(query.get('page', 1))
+        per_page = int(query.get('per_page', 100))
+        low = float(query.get('price_range_min', 0))
+        high = float(query.get('price_range_max', 400))
+        if (low, high) == (0, 400):  # the whole catalogue, including vintages with no price
+            matches = self.catalogue
+        elif (low, high) == (0, 0):
+            matches = [match for match in self.catalogue if match['price'] is None]
+        else:
+            matches = [match for match in self.catalogue
+                       if match['price'] is not None and low <= match['price']['amount'] <= high]
+        page_matches = matches[(page - 1) * per_page:page * per_page] if page <= self.page_cap else []
+        return {'explore_vintage': {'records_matched': len(matches), 'matches': page_matches}}
+
+    def latest_reviews(self, wine_id: int, query: Dict) -> Dict:
+        vintage = self.vintages_by_wine.get(wine_id)
+        if vintage is None:
+            return {'reviews': []}
+        return {'reviews': make_reviews(vintage, int(query.get('page', 1)), int(query.get('per_page', 50)))}
+
+
+class MockVivinoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keeps connections alive, as the real API does
+    disable_nagle_algorithm = True  # headers and body are sent apart, which would otherwise stall every response
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        reviews_match = re.fullmatch(r'/api/wines/(\d+)/latest_reviews', url.path)
+        if url.path == '/api/explore/explore':
+            endpoint = 'explore'
+        elif reviews_match:
+            endpoint = 'reviews'
+        else:
+            return self._send(404, {'error': 'not found'})
+        if server.latency:
+            time.sleep(server.latency)
+        status, retry_after = server.admit(endpoint)
+        if status != 200:
+            return self._send(status, {'error': 'injected'}, retry_after)
+        if endpoint == 'explore':
+            return self._send(200, server.explore(query))
+        return self._send(200, server.latest_reviews(int(reviews_match.group(1)), query))
+
+    def _send(self, status: int, body: Dict, retry_after=None) -> None:
+        with self.server._lock:
+            self.server.responses[status] = self.server.responses.get(status, 0) + 1
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(round(retry_after, 3)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the output of the crawler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic Vivino API locally')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--wines", type=int, default=5000, help="number of vintages in the catalogue")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--rate", type=float, default=None, help="requests per second allowed per endpoint family")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 5xx")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests failing with 429")
+    parser.add_argument("--page-cap", type=int, default=80, help="last explore page returning matches")
+    args = parser.parse_args()
+
+    server = MockVivino(args.port, args.wines, args.latency, args.rate, args.error_rate, args.throttle_rate,
+                        args.page_cap)
+    print(f"Serving {args.wines} vintages at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,126 @@
+from typing import List, Dict, Iterable
+from inserters import *
+
+
+class CompactRecord:
+    """
+    Read-only record keeping only some fields of a JSON object from the API, as a tuple behind a single slot instead
+    of a dictionary of all fields. Nested objects are records too, and lists become tuples. Fields are read as from a
+    dictionary (record['id'], record.get('id')), so that inserters, Crawler and ShardWriter accept records and raw
+    JSON alike; fields which were not kept read as missing.
+    """
+    __slots__ = ('_values',)
+    FIELDS = ()
+    _INDEX = {}  # field -> position of its value
+    _NESTED = {}  # field -> record type of the object (or of the elements of the list) it holds
+
+    def __init__(self, values: tuple):
+        self._values = values
+
+    @classmethod
+    def from_json(cls, obj: Dict) -> 'CompactRecord':
+        """
+        Function that builds a record from a JSON object, dropping the fields the record type does not keep
+        """
+        values = []
+        for field in cls.FIELDS:
+            value = obj.get(field)
+            nested = cls._NESTED.get(field)
+            if isinstance(value, list):
+                value = tuple(nested.from_json(element) if nested is not None and isinstance(element, dict)
+                              else element for element in value)
+            elif nested is not None and isinstance(value, dict):
+                value = nested.from_json(value)
+            values.append(value)
+        return cls(tuple(values))
+
+    def get(self, key: str, default=None) -> any:
+        index = self._INDEX.get(key)
+        return default if index is None else self._values[index]
+
+    def __getitem__(self, key: str) -> any:
+        index = self._INDEX.get(key)
+        if index is None:
+            raise KeyError(key)
+        return self._values[index]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._INDEX
+
+    def keys(self) -> tuple:
+        return self.FIELDS
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and other._values == self._values
+
+    __hash__ = None
+
+    def to_dict(self) -> Dict:
+        """
+        Function that turns the record back to a JSON object, holding only the fields kept
+        """
+        return {field: _to_json(value) for field, value in zip(self.FIELDS, self._values)}
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+def _to_json(value: any) -> any:
+    if isinstance(value, CompactRecord):
+        return value.to_dict()
+    if isinstance(value, tuple):
+        return [_to_json(element) for element in value]
+    return value
+
+
+def record_type(name: str, paths: Iterable[str]) -> type:
+    """
+    Function that creates a CompactRecord type keeping the values found at the given paths, eg. 'vintage/wine/id'
+    keeps the field vintage as a record keeping the field wine, itself a record keeping the field id
+    :param name: name of the type
+    :param paths: slash-separated paths; a path may go through a list, eg. 'vintage/wine/style/grapes/id'
+    :return: subclass of CompactRecord
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for key in path.split('/'):
+            node = node.setdefault(key, {})
+    return _record_type(name, tree)
+
+
+def _record_type(name: str, tree: Dict) -> type:
+    nested = {field: _record_type(f"{name}_{field}", subtree) for field, subtree in tree.items() if subtree}
+    fields = tuple(tree)
+    return type(name, (CompactRecord,), {'__slots__': (), 'FIELDS': fields,
+                                          '_INDEX': {field: i for i, field in enumerate(fields)}, '_NESTED': nested})
+
+
+def inserter_paths(inserters: List[Inserter]) -> List[str]:
+    """
+    Function that returns the paths of all values the given inserters read from a JSON record, including the lists
+    and the ids outside of them read by FromListInserter and FromListWithExternalIdInserter
+    """
+    paths = []
+    for inserter in inserters:
+        if isinstance(inserter, FromListInserter):
+            paths += [f"{inserter.path_to_list}/{path}" for path in inserter.paths] or [inserter.path_to_list]
+            if isinstance(inserter, FromListWithExternalIdInserter):
+                paths.append(inserter.path_to_id_outside_list)
+        else:
+            paths += inserter.paths
+    return paths
+
+
+# fields read outside of the inserters: by CrawlStats and the incremental crawl for reviews, by wines_as_df for wines
+REVIEW_EXTRA_PATHS = ['created_at', 'vintage/year', 'vintage/wine/id']
+VINTAGE_EXTRA_PATHS = ['vintage/has_valid_ratings', 'vintage/statistics/ratings_count',
+                       'vintage/wine/region/country/name']
+
+Review = record_type('Review', inserter_paths([UserInserter(), ActivityInserter(), ReviewInserter(),
+                                               VintageReviewInserter()]) + REVIEW_EXTRA_PATHS)
+Vintage = record_type('Vintage', inserter_paths([WineryInserter(), CountryInserter(), RegionInserter(),
+                                                 StyleInserter(), FoodInserter(), FactInserter(), StyleFoodInserter(),
+                                                 GrapeInserter(), StyleGrapeInserter(), CountryGrapeInserter(),
+                                                 WineInserter(), PriceInserter(), VintageInserter(),
+                                                 ToplistInserter(), VintageToplistInserter()]) + VINTAGE_EXTRA_PATHS)
@@ -1,5 +1,6 @@
 db_pass = ''
 db_url = ''
+db_pool_size = 4  # connections shared by the tables loaded concurrently in insert.py
 
 try:
     from secrets import *
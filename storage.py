@@ -0,0 +1,264 @@
+from typing import List, Dict, Iterator
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+
+try:
+    import zstandard
+except ImportError:  # fall back to gzip, which can be read everywhere
+    zstandard = None
+
+MANIFEST = 'manifest.json'  # shared by all datasets of a directory, only read for datasets written before
+MANIFEST_SUFFIX = '.manifest.json'
+SHARD_EXTENSIONS = ('.jsonl.zst', '.jsonl.gz')
+
+
+def get_value(record: Dict, path: str) -> any:
+    """
+    Function that returns a value found at a given slash-separated path inside a given JSON record
+    """
+    for p in path.split('/'):
+        if record is None:
+            break
+        record = record.get(p)
+    return record
+
+
+def _to_json(obj: any) -> any:
+    """
+    Function that turns compact records (see records.py) into JSON objects holding the fields they kept
+    """
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _manifest_path(directory: str, dataset: str) -> str:
+    return os.path.join(directory, dataset + MANIFEST_SUFFIX)
+
+
+def _read_legacy_manifest(directory: str) -> Dict:
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.isfile(path):
+        return {'shards': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_manifest(directory: str, dataset: str) -> Dict:
+    """
+    Function that reads the manifest describing the shards of a dataset. Every dataset has its own manifest, so that
+    processes crawling different datasets into the same directory never overwrite each other's entries. Datasets
+    written before that are listed in the manifest.json shared by the directory, which is only read.
+    :param directory: directory containing shards
+    :param dataset: name of the dataset, eg. France_2018
+    :return: dictionary with the list of shards, empty if the dataset has no shards yet
+    """
+    path = _manifest_path(directory, dataset)
+    if not os.path.isfile(path):
+        return {'shards': [shard for shard in _read_legacy_manifest(directory)['shards']
+                           if shard['dataset'] == dataset]}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(directory: str, dataset: str, manifest: Dict) -> None:
+    """
+    Function that replaces the manifest of a dataset atomically, so that a crash never leaves a half-written one behind
+    """
+    path = _manifest_path(directory, dataset)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def is_manifest_file(file_name: str) -> bool:
+    """
+    Function that tells whether a file name is that of a manifest, complete or still being written
+    """
+    if file_name.endswith('.tmp'):
+        file_name = file_name[:-len('.tmp')]
+    return file_name == MANIFEST or file_name.endswith(MANIFEST_SUFFIX)
+
+
+def list_datasets(directory: str) -> List[str]:
+    """
+    Function that returns the names of the datasets with a manifest in a directory, sorted
+    """
+    if not os.path.isdir(directory):
+        return []
+    datasets = {file_name[:-len(MANIFEST_SUFFIX)] for file_name in os.listdir(directory)
+                if file_name.endswith(MANIFEST_SUFFIX)}
+    datasets.update(shard['dataset'] for shard in _read_legacy_manifest(directory)['shards'])
+    return sorted(datasets)
+
+
+def list_shards(directory: str, dataset: str = None) -> List[Dict]:
+    """
+    Function that returns manifest entries of the shards in a directory, optionally only those of one dataset.
+    Shards are independent of each other, so they can be consumed in parallel.
+    :param directory: directory containing shards
+    :param dataset: name of the dataset, eg. France_2018; all datasets if None
+    :return: list of manifest entries, dataset by dataset, in the order they were written
+    """
+    datasets = list_datasets(directory) if dataset is None else [dataset]
+    return [shard for name in datasets for shard in read_manifest(directory, name)['shards']]
+
+
+def is_shard_file(file_name: str) -> bool:
+    """
+    Function that tells whether a file name is that of a shard, complete or still being written (see ShardWriter)
+    """
+    return file_name.endswith(SHARD_EXTENSIONS) or file_name.endswith(tuple(ext + '.tmp' for ext in SHARD_EXTENSIONS))
+
+
+def _file_checksum(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _open_for_reading(path: str):
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError(f"Package zstandard is required to read {path}")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True),
+                                encoding='utf-8')
+    return gzip.open(path, 'rt', encoding='utf-8')
+
+
+def read_shard(directory: str, shard: Dict, verify=False) -> Iterator[Dict]:
+    """
+    Generator that yields records of a single shard one by one
+    :param directory: directory containing shards
+    :param shard: manifest entry of the shard
+    :param verify: whether to compare the checksum of the file with the manifest before reading
+    :return: iterator over records
+    """
+    path = os.path.join(directory, shard['file'])
+    if verify and _file_checksum(path) != shard['sha256']:
+        raise ValueError(f"Checksum of shard {shard['file']} does not match the manifest")
+    with _open_for_reading(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def read_dataset(directory: str, dataset: str = None) -> Iterator[Dict]:
+    """
+    Generator that yields all records of a dataset shard by shard, without loading the dataset into memory
+    :param directory: directory containing shards
+    :param dataset: name of the dataset; all datasets if None
+    :return: iterator over records
+    """
+    for shard in list_shards(directory, dataset):
+        yield from read_shard(directory, shard)
+
+
+class ShardWriter:
+    """
+    Appends records of a dataset to compressed JSON lines shards (zstd if available, gzip otherwise).
+    A shard is closed once it holds max_bytes of uncompressed data, and is then added to the manifest together with
+    its record count, range of ids and checksum. Shards are never modified after that, so writing can continue
+    after a crash, and readers only ever see complete shards: a shard is written under a .tmp name and only gets its
+    final name once it is complete.
+    """
+
+    def __init__(self, directory: str, dataset: str, id_path='id', max_bytes=64 * 1024 ** 2, overwrite=False):
+        self.directory = directory
+        self.dataset = dataset
+        self.id_path = id_path
+        self.max_bytes = max_bytes
+        self.records_written = 0
+        self.extension = '.jsonl.zst' if zstandard is not None else '.jsonl.gz'
+        self._file = None
+        if overwrite:
+            self.remove_dataset()
+
+    def remove_dataset(self) -> None:
+        """
+        Function that deletes all shards of the dataset, eg. before crawling the same country and year again, together
+        with files of the dataset missing from the manifest, left behind by an interrupted crawl
+        """
+        for shard in read_manifest(self.directory, self.dataset)['shards']:
+            if os.path.isfile(os.path.join(self.directory, shard['file'])):
+                os.remove(os.path.join(self.directory, shard['file']))
+        if os.path.isdir(self.directory):
+            # an empty manifest of the dataset also hides its entries in the shared manifest.json, if any
+            _write_manifest(self.directory, self.dataset, {'shards': []})
+            orphan = re.compile(re.escape(self.dataset) + r'-\d{5}\.')
+            for file_name in os.listdir(self.directory):
+                if orphan.match(file_name) and is_shard_file(file_name):
+                    os.remove(os.path.join(self.directory, file_name))
+
+    def _next_file_name(self) -> tuple:
+        numbers = [shard['number'] for shard in list_shards(self.directory, self.dataset)]
+        number = max(numbers) + 1 if numbers else 0
+        return f"{self.dataset}-{number:05d}{self.extension}", number
+
+    def _open_shard(self) -> None:
+        self._file_name, self._number = self._next_file_name()
+        self._raw = open(os.path.join(self.directory, self._file_name + '.tmp'), 'wb')
+        if zstandard is not None:
+            stream = zstandard.ZstdCompressor(level=3).stream_writer(self._raw)
+        else:
+            stream = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        self._file = io.TextIOWrapper(stream, encoding='utf-8')
+        self._bytes = 0
+        self._records = 0
+        self._id_min = None
+        self._id_max = None
+
+    def _close_shard(self) -> None:
+        self._file.close()
+        self._raw.close()
+        self._file = None
+        path = os.path.join(self.directory, self._file_name)
+        os.replace(path + '.tmp', path)
+        manifest = read_manifest(self.directory, self.dataset)
+        manifest['shards'].append({
+            'dataset': self.dataset,
+            'number': self._number,
+            'file': self._file_name,
+            'records': self._records,
+            'id_min': self._id_min,
+            'id_max': self._id_max,
+            'bytes': os.path.getsize(path),
+            'sha256': _file_checksum(path),
+        })
+        _write_manifest(self.directory, self.dataset, manifest)
+
+    def write(self, records: List[Dict]) -> None:
+        """
+        Function that appends a page of records (raw JSON or compact records) to the current shard, closing it if
+        it grew too large
+        """
+        for record in records:
+            if self._file is None:
+                self._open_shard()
+            line = json.dumps(record, ensure_ascii=False, default=_to_json) + '\n'
+            self._file.write(line)
+            self._bytes += len(line)
+            self._records += 1
+            record_id = get_value(record, self.id_path)
+            if record_id is not None:
+                self._id_min = record_id if self._id_min is None else min(self._id_min, record_id)
+                self._id_max = record_id if self._id_max is None else max(self._id_max, record_id)
+            if self._bytes >= self.max_bytes:
+                self._close_shard()
+        self.records_written += len(records)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False